@@ -0,0 +1,235 @@
+# throughput benchmarks for the speedups section: the training step (forward, backward,
+# clip, AdamW step) and the kv-cached decode loop, for each of the lecture's toggles
+# applied on top of each other (fp32 -> tf32 -> bf16 -> flash attention -> vocab 50304
+# -> fused AdamW) and a few model sizes. small configs on cpu by default, so it runs on
+# any dev box. every measurement is warmup steps, then repeated timed trials, summarized
+# python bench.py                                       # writes bench.json, compares to bench_baseline.json
+# python bench.py --save_baseline                       # record bench_baseline.json (cpu, tiny,small)
+# python bench.py --baseline none                       # no comparison
+# the comparison exits 1 if anything got >10% slower than the baseline. the baseline is
+# machine specific: record it once on the box the checks run on, and commit it next to this file
+# python bench.py --configs gpt2 --device cuda --compile --table ../speedups.txt
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import time
+import torch
+
+from gpt import GPT, GPTConfig, KVCache
+from compiled import BucketedGPT
+
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+# model sizes: (GPTConfig kwargs, B, T). vocab_size is set per variant
+configs = {
+    "tiny": (dict(block_size=256, n_layer=2, n_head=4, n_embd=128), 4, 128),
+    "small": (dict(block_size=512, n_layer=4, n_head=4, n_embd=256), 4, 256),
+    "gpt2": (dict(block_size=1024, n_layer=12, n_head=12, n_embd=768), 4, 1024),
+}
+
+# each variant keeps all the toggles of the ones before it, like in the lecture
+variants = []
+toggles = dict(tf32=False, bf16=False, flash=False, vocab=50257, fused=False, compile=False)
+for name, change in [
+    ("fp32", {}),
+    ("tf32", dict(tf32=True)),
+    ("bf16", dict(bf16=True)),
+    ("flash", dict(flash=True)),
+    ("vocab 50304", dict(vocab=50304)),
+    ("fused adamw", dict(fused=True)),
+    ("compile", dict(compile=True)), # only with --compile
+]:
+    toggles = {**toggles, **change}
+    variants.append((name, toggles))
+
+def sync(device):
+    if 'cuda' in device:
+        torch.cuda.synchronize()
+    elif 'mps' in device:
+        torch.mps.synchronize()
+
+def attention_backend(flash):
+    # flash off = the plain math implementation of attention, softmax(q @ k.T) @ v
+    if flash:
+        return contextlib.nullcontext()
+    from torch.nn.attention import sdpa_kernel, SDPBackend
+    return sdpa_kernel(SDPBackend.MATH)
+
+def summarize(times, tokens):
+    # times in seconds, one per trial, each processing `tokens` tokens
+    median = statistics.median(times)
+    return {
+        "tokens": tokens,
+        "trials": len(times),
+        "dt_ms": [t * 1000 for t in times],
+        "dt_ms_mean": statistics.mean(times) * 1000,
+        "dt_ms_std": statistics.stdev(times) * 1000 if len(times) > 1 else 0.0,
+        "dt_ms_median": median * 1000,
+        "dt_ms_min": min(times) * 1000,
+        "tok_per_sec": tokens / median, # median: one slow trial (gc, another process) doesn't move it
+    }
+
+def bench_train(model, B, T, toggles, device, warmup, trials):
+    device_type = 'cuda' if 'cuda' in device else 'cpu'
+    optimizer = model.configure_optimizers(weight_decay=0.1, learning_rate=6e-4, device_type=device_type, fused=toggles['fused'])
+    gen = torch.Generator().manual_seed(1337)
+    x = torch.randint(0, 50257, (B, T), generator=gen).to(device)
+    y = torch.randint(0, 50257, (B, T), generator=gen).to(device)
+    times, losses = [], []
+    for i in range(warmup + trials):
+        sync(device)
+        t0 = time.perf_counter()
+        optimizer.zero_grad(set_to_none=True)
+        with torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=toggles['bf16']):
+            logits, loss = model(x, y)
+        loss.backward()
+        torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+        optimizer.step()
+        sync(device)
+        if i >= warmup:
+            times.append(time.perf_counter() - t0)
+            losses.append(loss.item())
+    result = summarize(times, B * T)
+    result["loss"] = losses
+    return result
+
+@torch.no_grad()
+def bench_decode(model, B, prompt_len, n_tokens, toggles, device, warmup, trials):
+    # prefill a prompt, then time n_tokens single token steps for B sequences at once
+    device_type = 'cuda' if 'cuda' in device else 'cpu'
+    gen = torch.Generator().manual_seed(1337)
+    prompt = torch.randint(0, 50257, (B, prompt_len), generator=gen).to(device)
+    kv_cache = KVCache(model.config, B, max_len=prompt_len + n_tokens)
+    times = []
+    for i in range(warmup + trials):
+        kv_cache.reset()
+        with torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=toggles['bf16']):
+            logits, _ = model(prompt, kv_cache=kv_cache, last_only=True)
+            sync(device)
+            t0 = time.perf_counter()
+            for _ in range(n_tokens):
+                idx = logits[:, -1, :50257].argmax(dim=-1, keepdim=True)
+                logits, _ = model(idx, kv_cache=kv_cache, last_only=True)
+            sync(device)
+        if i >= warmup:
+            times.append(time.perf_counter() - t0)
+    return summarize(times, B * n_tokens)
+
+def run(config_name, variant, toggles, args):
+    config_args, B, T = configs[config_name]
+    if args.T:
+        T = min(args.T, config_args['block_size'])
+    torch.set_float32_matmul_precision('high' if toggles['tf32'] else 'highest')
+    torch.manual_seed(1337)
+    model = GPT(GPTConfig(vocab_size=toggles['vocab'], **config_args))
+    model.to(args.device)
+    train_model = torch.compile(model) if toggles['compile'] else model
+    decode_model = BucketedGPT(model) if toggles['compile'] else model
+    results = []
+    with attention_backend(toggles['flash']):
+        model.train()
+        train = bench_train(train_model, B, T, toggles, args.device, args.warmup, args.trials)
+        results.append({"config": config_name, "variant": variant, "bench": "train", "B": B, "T": T, **train})
+        model.eval()
+        n_tokens = min(args.decode_tokens, config_args['block_size'] // 2)
+        decode = bench_decode(decode_model, B, T // 2, n_tokens, toggles, args.device, args.warmup, args.trials)
+        results.append({"config": config_name, "variant": variant, "bench": "decode", "B": B, "T": T // 2, **decode})
+    return results
+
+def key(r):
+    return f"{r['config']} / {r['variant']} / {r['bench']}"
+
+def compare(results, baseline, tolerance):
+    # match results to the baseline by config / variant / bench, flag anything slower than
+    # baseline * (1 - tolerance). returns the regressed keys
+    base = {key(r): r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        b = base.get(key(r))
+        if b is None:
+            continue
+        ratio = r["tok_per_sec"] / b["tok_per_sec"]
+        flag = ""
+        if ratio < 1 - tolerance:
+            regressions.append(key(r))
+            flag = "  <-- REGRESSION"
+        print(f"{key(r):40s} {b['tok_per_sec']:12.1f} -> {r['tok_per_sec']:12.1f} tok/sec ({ratio:.2f}x){flag}")
+    return regressions
+
+def write_table(results, device, path):
+    # same format as the hand pasted logs in speedups.txt: a comment per run, then its steps
+    with open(path, "w") as f:
+        for r in results:
+            if r["bench"] != "train":
+                continue
+            f.write(f"# this is {r['variant']} on {device} ({r['config']}, B={r['B']}, T={r['T']})\n")
+            for step, (dt, loss) in enumerate(zip(r["dt_ms"], r["loss"])):
+                f.write(f"step {step}, loss: {loss:.6f}, dt: {dt:.2f}ms, tok/sec: {r['tokens'] / (dt / 1000):.2f}\n")
+            f.write("\n")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--configs", type=str, default="tiny,small", help=f"comma separated, of {','.join(configs)}")
+    parser.add_argument("--variants", type=str, default=None, help="comma separated, default: all (compile only with --compile)")
+    parser.add_argument("--compile", action="store_true")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--T", type=int, default=0, help="override the sequence length of every config")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--trials", type=int, default=5)
+    parser.add_argument("--decode_tokens", type=int, default=32)
+    parser.add_argument("--threads", type=int, default=0, help="torch cpu threads, 0 = torch default")
+    parser.add_argument("--out", type=str, default="bench.json")
+    parser.add_argument("--baseline", type=str, default=default_baseline, help="a previous --out file to compare against, none = skip")
+    parser.add_argument("--save_baseline", action="store_true", help="also write the results to --baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--table", type=str, default=None, help="also write the train steps in the speedups.txt format")
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    names = args.variants.split(",") if args.variants else [n for n, _ in variants if n != "compile" or args.compile]
+    selected = [(n, t) for n, t in variants if n in names]
+    assert len(selected) == len(names), f"unknown variant in {names}"
+
+    results = []
+    for config_name in args.configs.split(","):
+        for variant, toggles in selected:
+            for r in run(config_name, variant, toggles, args):
+                print(f"{key(r):40s} {r['dt_ms_median']:10.2f}ms (+-{r['dt_ms_std']:.2f}) {r['tok_per_sec']:12.1f} tok/sec")
+                results.append(r)
+
+    report = {
+        "env": {
+            "device": args.device,
+            "torch": torch.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "threads": torch.get_num_threads(),
+            "cuda": torch.cuda.get_device_name() if 'cuda' in args.device else None,
+        },
+        "args": vars(args),
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    if args.table:
+        write_table(results, args.device, args.table)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"wrote baseline {args.baseline}")
+    elif args.baseline != "none" and not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}, record one with --save_baseline")
+    elif args.baseline != "none":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["env"]["torch"] != report["env"]["torch"] or baseline["env"]["threads"] != report["env"]["threads"]:
+            print(f"warning: baseline ran on torch {baseline['env']['torch']} / {baseline['env']['threads']} threads")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.tolerance:.0%}")
+            raise SystemExit(1)
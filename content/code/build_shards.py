@@ -0,0 +1,144 @@
+# builds the token shards RandomAccessLoader reads from ../data/edu_fineweb10B:
+# streams documents from local files (.jsonl with a "text" field, .parquet with a "text"
+# column, or .txt = one document per file), tokenizes them on a process pool in batches,
+# each document prefixed with <|endoftext|>, and writes shards of exactly shard_size
+# uint16 tokens. the first shard is the val split, the rest train (same as fineweb.py).
+# after every shard the position in the corpus is saved, so a killed run picks up there
+# python build_shards.py --input "../data/fineweb-edu/*.parquet"
+# python build_shards.py --input "corpus/*.jsonl" --out_dir ../data/mine --shard_size 10000000
+import argparse
+import glob
+import json
+import os
+import time
+import multiprocessing as mp
+import numpy as np
+import tiktoken
+
+enc = tiktoken.get_encoding("gpt2")
+eot = enc._special_tokens['<|endoftext|>'] # end of text token, delimits documents
+
+def iterate_documents(files, start_file=0, start_doc=0):
+    # yields (file index, document index in that file, text), starting at the given document
+    for fi in range(start_file, len(files)):
+        path = files[fi]
+        skip = start_doc if fi == start_file else 0
+        if path.endswith(".parquet"):
+            import pyarrow.parquet as pq # only needed for parquet input
+            texts = (t for batch in pq.ParquetFile(path).iter_batches(columns=["text"]) for t in batch.column(0).to_pylist())
+        elif path.endswith(".jsonl"):
+            texts = (json.loads(line)["text"] if i >= skip else None for i, line in enumerate(open(path, encoding="utf-8")))
+        else:
+            texts = iter([open(path, encoding="utf-8").read()])
+        for di, text in enumerate(texts):
+            if di >= skip:
+                yield fi, di, text
+
+def batched(documents, batch_size):
+    batch = []
+    for doc in documents:
+        batch.append(doc)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def tokenize(batch):
+    # runs in a worker: [(fi, di, text)] -> [(fi, di, uint16 tokens)]
+    tokens = enc.encode_ordinary_batch([text for _, _, text in batch], num_threads=1)
+    out = []
+    for (fi, di, _), toks in zip(batch, tokens):
+        toks = np.array([eot] + toks, dtype=np.int64)
+        assert toks.max() < 2**16, "token dictionary too large for uint16"
+        out.append((fi, di, toks.astype(np.uint16)))
+    return out
+
+def shard_path(out_dir, prefix, index):
+    split = "val" if index == 0 else "train"
+    return os.path.join(out_dir, f"{prefix}_{split}_{index:06d}.npy")
+
+def write_atomic(path, write):
+    with open(path + ".tmp", "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, nargs="+", required=True, help="files or globs, read in sorted order")
+    parser.add_argument("--out_dir", type=str, default="../data/edu_fineweb10B")
+    parser.add_argument("--prefix", type=str, default="edufineweb")
+    parser.add_argument("--shard_size", type=int, default=int(1e8), help="tokens per shard")
+    parser.add_argument("--batch_size", type=int, default=256, help="documents per task sent to a worker")
+    parser.add_argument("--nprocs", type=int, default=max(1, os.cpu_count() - 1))
+    args = parser.parse_args()
+
+    files = sorted(f for pattern in args.input for f in glob.glob(pattern))
+    assert len(files) > 0, f"no input files match {args.input}"
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    # resume: the next shard to write, and where in the corpus its first token comes from
+    # (file, document, and how many tokens of that document the previous shard already took)
+    state_path = os.path.join(args.out_dir, f"{args.prefix}_state.json")
+    state = dict(files=files, shard_size=args.shard_size, shard=0, file=0, doc=0, skip=0, done=False)
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            saved = json.load(f)
+        assert saved["files"] == files and saved["shard_size"] == args.shard_size, \
+            f"{state_path} is from a different input / shard size, delete it to start over"
+        state = saved
+        if state["done"]:
+            print(f"all done already ({state['shard']} shards), delete {state_path} to rebuild")
+            raise SystemExit
+        print(f"resuming at shard {state['shard']}, file {state['file']}, document {state['doc']}")
+
+    buf = np.empty((args.shard_size,), dtype=np.uint16)
+    n = 0 # tokens in buf
+    shard = state["shard"]
+    start = (state["file"], state["doc"], state["skip"]) # where the shard in buf begins
+    t0 = time.time()
+    total_tokens, total_docs = 0, 0
+    documents = iterate_documents(files, state["file"], state["doc"])
+
+    def flush(tokens_in_buf, next_start, done=False):
+        global shard, t0
+        path = shard_path(args.out_dir, args.prefix, shard)
+        write_atomic(path, lambda f: np.save(f, buf[:tokens_in_buf]))
+        dt = time.time() - t0
+        print(f"wrote {path}: {tokens_in_buf:,} tokens in {dt:.1f}s, {tokens_in_buf / dt:,.0f} tok/sec, "
+              f"{total_docs / dt:,.0f} docs/sec ({args.nprocs} procs)")
+        shard += 1
+        fi, di, skip = next_start
+        new_state = dict(files=files, shard_size=args.shard_size, shard=shard, file=fi, doc=di, skip=skip, done=done)
+        write_atomic(state_path, lambda f: f.write(json.dumps(new_state).encode()))
+        t0 = time.time()
+
+    with mp.Pool(args.nprocs) as pool:
+        for results in pool.imap(tokenize, batched(documents, args.batch_size)):
+            for fi, di, tokens in results:
+                taken = 0 # tokens of this document in shards so far
+                if (fi, di) == start[:2]:
+                    taken = start[2] # the previous shard ended in the middle of this document
+                    tokens = tokens[taken:]
+                total_docs += 1
+                while len(tokens) > 0:
+                    k = min(len(tokens), args.shard_size - n)
+                    buf[n:n+k] = tokens[:k]
+                    n += k
+                    taken += k
+                    total_tokens += k
+                    tokens = tokens[k:]
+                    if n == args.shard_size:
+                        # the next shard starts with the rest of this document, if any
+                        start = (fi, di + 1, 0) if len(tokens) == 0 else (fi, di, taken)
+                        flush(n, start)
+                        n = 0
+                        total_docs = 0
+    if n > 0:
+        flush(n, (len(files), 0, 0), done=True) # the last, partial shard
+    else:
+        state = dict(files=files, shard_size=args.shard_size, shard=shard, file=len(files), doc=0, skip=0, done=True)
+        write_atomic(state_path, lambda f: f.write(json.dumps(state).encode()))
+    print(f"done: {shard} shards, {total_tokens:,} tokens this run")
@@ -0,0 +1,208 @@
+import os
+import re
+import json
+import shutil
+import threading
+from dataclasses import asdict
+import torch
+
+# -----------------------------------------------------------------------------
+# checkpoints: log/model_XXXXX/ directories holding
+#   model.pt       the weights (minus the constant causal-mask buffers)
+#   optimizer.pt   the optimizer state tensors (AdamW moments and steps)
+#   manifest.json  everything else: step, val loss, config, param groups, loader state, rng
+# the tensor files are loaded with mmap, so resuming pages each tensor in from disk as it
+# is copied into the model / optimizer instead of deserializing one big pickle up front.
+# log/model_XXXXX.pt single-file checkpoints from older runs still load.
+# a checkpoint is written under a temp name and renamed into place once complete, so
+# anything matching the name below is a whole checkpoint, never one a crash cut off mid-write.
+# log/snapshot_XXXXX.pt: just the weights, config and step, for eval_checkpoint.py --watch
+# to score out of band. written the same way, deleted once scored
+
+checkpoint_re = re.compile(r"^model_(\d+)(\.pt)?$")
+snapshot_re = re.compile(r"^snapshot_(\d+)\.pt$")
+
+def list_checkpoints(log_dir):
+    # completed checkpoints in log_dir as (step, path), oldest first
+    if not os.path.exists(log_dir):
+        return []
+    checkpoints = []
+    for f in os.listdir(log_dir):
+        m = checkpoint_re.match(f)
+        path = os.path.join(log_dir, f)
+        if m and (m.group(2) or os.path.exists(os.path.join(path, "manifest.json"))):
+            checkpoints.append((int(m.group(1)), path))
+    return sorted(checkpoints)
+
+def list_snapshots(log_dir):
+    # completed eval snapshots in log_dir as (step, path), oldest first
+    if not os.path.exists(log_dir):
+        return []
+    snapshots = []
+    for f in os.listdir(log_dir):
+        m = snapshot_re.match(f)
+        if m:
+            snapshots.append((int(m.group(1)), os.path.join(log_dir, f)))
+    return sorted(snapshots)
+
+def latest_checkpoint(log_dir):
+    checkpoints = list_checkpoints(log_dir)
+    return checkpoints[-1][1] if checkpoints else None
+
+def to_host(obj, memo=None):
+    # copy every tensor in a (nested) state dict to cpu memory, so training can keep
+    # updating the live tensors while the copy is written out. the memo keeps tensors
+    # that appear twice (the tied wte / lm_head weight) as one copy
+    memo = {} if memo is None else memo
+    if isinstance(obj, torch.Tensor):
+        key = (obj.device, obj.data_ptr(), obj.dtype, obj.shape, obj.stride()) # state_dict() hands out a fresh view per name
+        if key not in memo:
+            memo[key] = obj.detach().to('cpu', copy=True)
+        return memo[key]
+    if isinstance(obj, dict):
+        return {k: to_host(v, memo) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_host(v, memo) for v in obj)
+    return obj
+
+def fsync_save(obj, path):
+    with open(path, "wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+def save_checkpoint(checkpoint, path):
+    # write a checkpoint dict (as built in the training loop) as a model_XXXXX/ directory
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    fsync_save(checkpoint['model'], os.path.join(tmp_path, "model.pt"))
+    fsync_save(checkpoint['optimizer']['state'], os.path.join(tmp_path, "optimizer.pt"))
+    manifest = {k: v for k, v in checkpoint.items() if k not in ('model', 'optimizer', 'config', 'rng_state', 'cuda_rng_state')}
+    manifest['config'] = asdict(checkpoint['config'])
+    manifest['param_groups'] = checkpoint['optimizer']['param_groups']
+    manifest['rng_state'] = checkpoint['rng_state'].tolist()
+    cuda_rng_state = checkpoint.get('cuda_rng_state')
+    manifest['cuda_rng_state'] = cuda_rng_state.tolist() if cuda_rng_state is not None else None
+    with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    shutil.rmtree(path, ignore_errors=True) # a leftover from a run that crashed after this step
+    os.replace(tmp_path, path) # atomic: the checkpoint appears complete or not at all
+
+def save_snapshot(snapshot, path):
+    # snapshot: dict(model=state dict, config=GPTConfig, step=int). plain types only, so it
+    # loads with weights_only
+    obj = {'model': snapshot['model'], 'config': asdict(snapshot['config']), 'step': snapshot['step']}
+    fsync_save(obj, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+def load_snapshot(path):
+    # same keys as load_checkpoint returns, for the ones a snapshot has
+    from gpt import GPTConfig
+    snapshot = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    snapshot['config'] = GPTConfig(**snapshot['config'])
+    return snapshot
+
+def load_model_state(model, model_sd):
+    # copy a state dict into an existing model tensor by tensor (GPT.from_state_dict builds
+    # one around it instead). the causal-mask buffers of older checkpoints get dropped
+    model.load_state_dict(model_sd)
+
+def load_checkpoint(path, model=None):
+    # returns the checkpoint as the same dict the training loop saved. the tensors stay
+    # memory-mapped on cpu until they're copied somewhere (load_state_dict moves them to
+    # the device of the model / optimizer). with a model, the weights are streamed
+    # straight into it and left out of the returned dict
+    from gpt import GPTConfig
+    if not os.path.isdir(path):
+        # old single pickle format
+        checkpoint = torch.load(path, map_location='cpu', mmap=True, weights_only=False)
+    else:
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+        checkpoint = {k: v for k, v in manifest.items() if k not in ('config', 'param_groups', 'rng_state', 'cuda_rng_state')}
+        checkpoint['config'] = GPTConfig(**manifest['config'])
+        checkpoint['rng_state'] = torch.tensor(manifest['rng_state'], dtype=torch.uint8)
+        if manifest['cuda_rng_state'] is not None:
+            checkpoint['cuda_rng_state'] = torch.tensor(manifest['cuda_rng_state'], dtype=torch.uint8)
+        checkpoint['model'] = torch.load(os.path.join(path, "model.pt"), map_location='cpu', mmap=True, weights_only=True)
+        state = torch.load(os.path.join(path, "optimizer.pt"), map_location='cpu', mmap=True, weights_only=True)
+        checkpoint['optimizer'] = {'state': state, 'param_groups': manifest['param_groups']}
+    if model is not None:
+        load_model_state(model, checkpoint.pop('model'))
+    return checkpoint
+
+class CheckpointWriter:
+    # saves checkpoints on a background thread: save() only pays for the device -> host
+    # copy, torch.save runs while the next steps train. at most one write is in flight,
+    # and only the newest `keep` checkpoints are kept on disk (0 = keep all). eval snapshots
+    # are deleted by the eval worker once scored, but if it's not running or falls behind,
+    # only the newest `keep_snapshots` unscored ones stay (0 = keep all)
+
+    def __init__(self, log_dir, keep=3, keep_snapshots=3):
+        self.log_dir = log_dir
+        self.keep = keep
+        self.keep_snapshots = keep_snapshots
+        self.thread = None
+        self.error = None
+
+    def save(self, checkpoint, step):
+        self.wait() # the previous write has to land first
+        snapshot = to_host(checkpoint)
+        path = os.path.join(self.log_dir, f"model_{step:05d}")
+        self.thread = threading.Thread(target=self._write, args=(snapshot, path), daemon=True)
+        self.thread.start()
+
+    def save_snapshot(self, snapshot, step):
+        # an eval snapshot (see save_snapshot), through the same single background writer
+        self.wait()
+        snapshot = to_host(snapshot)
+        path = os.path.join(self.log_dir, f"snapshot_{step:05d}.pt")
+        self.thread = threading.Thread(target=self._write_snapshot, args=(snapshot, path), daemon=True)
+        self.thread.start()
+
+    def _write(self, snapshot, path):
+        try:
+            save_checkpoint(snapshot, path)
+            self._prune()
+        except Exception as e:
+            self.error = e
+            shutil.rmtree(path + ".tmp", ignore_errors=True)
+
+    def _write_snapshot(self, snapshot, path):
+        try:
+            save_snapshot(snapshot, path)
+            self._prune_snapshots()
+        except Exception as e:
+            self.error = e
+            if os.path.exists(path + ".tmp"):
+                os.remove(path + ".tmp")
+
+    def _prune(self):
+        if self.keep <= 0:
+            return
+        for _, path in list_checkpoints(self.log_dir)[:-self.keep]:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+    def _prune_snapshots(self):
+        if self.keep_snapshots <= 0:
+            return
+        for _, path in list_snapshots(self.log_dir)[:-self.keep_snapshots]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass # the eval worker just scored and removed it
+
+    def wait(self):
+        # block until the write in flight (if any) is on disk, re-raise if it failed
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
@@ -0,0 +1,69 @@
+import torch
+from torch.nn import functional as F
+
+# -----------------------------------------------------------------------------
+# torch.compile for the eval paths: val loss, HellaSwag and sampling all feed the model
+# shapes that change from call to call (example lengths, a kv cache growing by one
+# token per step), and a compiled model specializes on shapes, so each new one means a
+# recompile. here every input is padded up to one of a few bucket shapes first, which
+# caps the number of graphs: right padding doesn't change the logits of the real
+# positions (causal attention), padded targets are ignore_index, and a kv-cached decode
+# step attends over a bucket of cache slots with the slots past each row's length masked
+
+# every bucket shape of every path is a cache entry of the same GPT.forward code object
+torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+
+def bucket(n, buckets):
+    # smallest bucket that fits n (n itself past the largest one)
+    for b in buckets:
+        if n <= b:
+            return b
+    return n
+
+def pow2_buckets(lo, hi):
+    buckets = [lo]
+    while buckets[-1] < hi:
+        buckets.append(min(2 * buckets[-1], hi))
+    return buckets
+
+class BucketedGPT:
+    # an eval-mode stand-in for a GPT: same call signature, compiled with static shapes
+
+    def __init__(self, model, min_len=64, max_rows=1024):
+        self.model = model
+        self.config = model.config
+        self.compiled = torch.compile(model, dynamic=False) # separate from the training graph
+        self.len_buckets = pow2_buckets(min_len, model.config.block_size)
+        self.row_buckets = pow2_buckets(1, max_rows)
+
+    def __call__(self, idx, targets=None, kv_cache=None, last_only=False):
+        if kv_cache is not None:
+            return self.decode(idx, kv_cache, last_only)
+        B, T = idx.size()
+        Bp, Tp = bucket(B, self.row_buckets), bucket(T, self.len_buckets)
+        idx = F.pad(idx, (0, Tp - T, 0, Bp - B))
+        if targets is not None:
+            targets = F.pad(targets, (0, Tp - T, 0, Bp - B), value=-100) # ignored by the loss
+        logits, loss = self.compiled(idx, targets)
+        if logits is not None:
+            logits = logits[:B, [T - 1]] if last_only else logits[:B, :T]
+        return logits, loss
+
+    def decode(self, idx, kv_cache, last_only):
+        if kv_cache.k is None or (kv_cache.lengths is None and kv_cache.pos == 0):
+            # the prefill (it also allocates the cache). once per sequence, so it runs
+            # eagerly rather than compiling a graph for every prompt length
+            return self.model(idx, kv_cache=kv_cache, last_only=last_only)
+        assert kv_cache.valid is None, "right-padded cached prefixes are not supported here"
+        if kv_cache.lengths is None:
+            # switch to per-row lengths: they live in a device tensor, so the graph doesn't
+            # depend on how far along the sequence is, only on the attended bucket below
+            kv_cache.set_lengths([kv_cache.pos] * kv_cache.batch_size, idx.device)
+            kv_cache.pos = 0
+        T = idx.size(1)
+        assert kv_cache.max_length + T <= kv_cache.max_len, f"kv cache full: {kv_cache.max_length} + {T} > {kv_cache.max_len}"
+        kv_cache.attend_len = min(bucket(kv_cache.max_length + T, self.len_buckets), kv_cache.max_len)
+        try:
+            return self.compiled(idx, kv_cache=kv_cache, last_only=last_only)
+        finally:
+            kv_cache.attend_len = None
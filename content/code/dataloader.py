@@ -0,0 +1,209 @@
+import os
+import threading
+import queue
+import numpy as np
+import torch
+
+# same as the training script: rank 0 of a torchrun job, or no ddp at all
+master_process = int(os.environ.get('RANK', 0)) == 0
+
+data_root = "../data/edu_fineweb10B"
+
+# -----------------------------------------------------------------------------
+
+def load_tokens(filename):
+    # memory-map the shard instead of reading it: the uint16 tokens stay on disk
+    # (well, in the page cache) and only the slice each batch touches gets read.
+    # switching shards is then basically free, and no rank holds a 4x int64 copy
+    try:
+        npt = np.load(filename, mmap_mode='r')
+        return npt
+    except Exception as e:
+        print(f"Error loading {filename}: {e}")
+        # Try to peek at the file content
+        with open(filename, 'rb') as f:
+            header = f.read(16)
+            print(f"File header (first 16 bytes): {header}")
+        raise e
+
+def get_shards(split):
+    shards = os.listdir(data_root)
+    shards = [s for s in shards if split in s]
+    shards = sorted(shards)
+    shards = [os.path.join(data_root, s) for s in shards]
+    return shards
+
+class RandomAccessLoader:
+    # every sample (a window of T+1 tokens, consecutive windows sharing the one token that
+    # is the last target of one and the first input of the next) has a global index across
+    # all shards of the split. the shard lengths give the cumulative window count per
+    # shard, which maps a global index to (shard, offset) with one binary search.
+    # each epoch visits all samples in a seeded random order (or in order, without shuffle).
+    # the only state is how many samples the whole job has consumed: rank r of n takes
+    # samples [cursor + r*B, cursor + (r+1)*B) of that order, then cursor moves by n*B.
+    # so resuming at step s is cursor = s * samples per step, whatever the world size and
+    # B of the run that wrote the checkpoint, and nothing gets replayed or skipped
+
+    def __init__(self, B, T, process_rank, num_processes, split, shuffle=True, seed=1337):
+        self.B = B
+        self.T = T
+        self.process_rank = process_rank
+        self.num_processes = num_processes
+        self.shuffle = shuffle
+        self.seed = seed
+        assert split in {'train', 'val'}
+        self.shards = get_shards(split)
+        assert len(self.shards) > 0, f"no shards found for split {split}"
+        self.tokens = [load_tokens(shard) for shard in self.shards] # mmaps, only the headers get read here
+        windows = np.array([(len(tokens) - 1) // T for tokens in self.tokens])
+        self.shard_ends = np.cumsum(windows) # global index one past the last window of each shard
+        self.num_samples = int(self.shard_ends[-1])
+        self.perm_epoch = None
+        self.perm = None
+        self.cursor = 0
+        if master_process:
+            print(f"found {len(self.shards)} shards for split {split}, {self.num_samples:,} samples of {T} tokens")
+
+    def reset(self):
+        self.cursor = 0
+
+    def get_state(self):
+        return (self.cursor,)
+
+    def set_state(self, cursor):
+        self.cursor = cursor
+
+    def epoch_order(self, epoch):
+        # the sample order of an epoch, a permutation that only depends on (seed, epoch)
+        if self.perm_epoch != epoch:
+            rng = np.random.default_rng([self.seed, epoch])
+            self.perm = rng.permutation(self.num_samples)
+            self.perm_epoch = epoch
+        return self.perm
+
+    def locate(self, index):
+        # global sample indices -> (shard, token offset in the shard)
+        shard = np.searchsorted(self.shard_ends, index, side='right')
+        first = np.where(shard > 0, self.shard_ends[shard - 1], 0)
+        return shard, (index - first) * self.T
+
+    def next_batch(self):
+        B, T = self.B, self.T
+        positions = self.cursor + self.process_rank * B + np.arange(B) # in the never ending stream of epochs
+        epochs, index = np.divmod(positions, self.num_samples)
+        if self.shuffle:
+            for epoch in np.unique(epochs): # a batch straddles two epochs at most
+                index[epochs == epoch] = self.epoch_order(epoch)[index[epochs == epoch]]
+        shards, offsets = self.locate(index)
+        buf = np.stack([self.tokens[shard][offset:offset+T+1] for shard, offset in zip(shards, offsets)])
+        buf = torch.from_numpy(buf.astype(np.int64)) # (B, T+1)
+        x = buf[:, :-1] # inputs
+        y = buf[:, 1:] # targets
+        self.cursor += B * self.num_processes
+        return x, y
+
+class PrefetchLoader:
+    # runs a loader (RandomAccessLoader) on a background thread that keeps
+    # the next `depth` batches ready (in pinned memory when we train on cuda, so the copy
+    # to the gpu can be non_blocking). the step no longer stalls on a shard switch or a
+    # pageable host-to-device copy. the batches come out in exactly the same order, and
+    # get_state() describes the loader right after the last batch we *handed out*,
+    # not the read-ahead, so checkpoints still resume at the exact same batch
+
+    def __init__(self, loader, depth=4, pin_memory=False):
+        self.loader = loader
+        self.B = loader.B
+        self.T = loader.T
+        self.depth = depth
+        self.pin_memory = pin_memory
+        self.state = loader.get_state()
+        self.batches = None
+        self.stop_event = None
+        self.worker = None
+
+    def _work(self, batches, stop_event):
+        try:
+            while not stop_event.is_set():
+                x, y = self.loader.next_batch()
+                if self.pin_memory:
+                    x, y = x.pin_memory(), y.pin_memory()
+                self._put(batches, stop_event, (x, y, self.loader.get_state()))
+        except Exception as e:
+            # hand it to the consumer: a dead worker would otherwise leave it waiting forever
+            self._put(batches, stop_event, e)
+
+    def _put(self, batches, stop_event, item):
+        while not stop_event.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _start(self):
+        # the worker reads ahead starting from wherever the consumer currently is
+        self.loader.set_state(*self.state)
+        self.batches = queue.Queue(maxsize=self.depth)
+        self.stop_event = threading.Event()
+        self.worker = threading.Thread(target=self._work, args=(self.batches, self.stop_event), daemon=True)
+        self.worker.start()
+
+    def _stop(self):
+        # drop the read-ahead, the next next_batch restarts from the consumed state
+        if self.worker is not None:
+            self.stop_event.set()
+            self.worker.join()
+            self.worker = None
+
+    def reset(self):
+        self._stop()
+        self.loader.reset()
+        self.state = self.loader.get_state()
+
+    def get_state(self):
+        return self.state
+
+    def set_state(self, *state):
+        self._stop()
+        self.state = state
+
+    def next_batch(self):
+        if self.worker is None:
+            self._start()
+        while True:
+            try:
+                item = self.batches.get(timeout=1.0)
+                break
+            except queue.Empty:
+                if not self.worker.is_alive():
+                    self.worker = None
+                    raise RuntimeError("prefetch worker died without a batch or an error")
+        if isinstance(item, Exception):
+            self._stop() # the next call starts over from the last batch handed out
+            raise item
+        x, y, self.state = item
+        return x, y
+
+class ValSet:
+    # the fixed validation set: the first num_tokens tokens of the first val shard, cut into
+    # rows of T (+1 for the targets). read once and kept resident on device, each rank keeps
+    # every num_processes-th row. scoring it is then independent of the batch size and the
+    # number of ranks, so a checkpoint gets the same val loss in training and offline
+    def __init__(self, num_tokens, T, process_rank, num_processes, device, split="val"):
+        self.T = T
+        shards = get_shards(split)
+        assert len(shards) > 0, f"no shards found for split {split}"
+        tokens = load_tokens(shards[0])
+        n_rows = num_tokens // T
+        assert n_rows * T + 1 <= len(tokens), f"val shard too small for {num_tokens} tokens"
+        buf = torch.from_numpy(tokens[:n_rows * T + 1].astype(np.int64))
+        x = buf[:-1].view(n_rows, T)
+        y = buf[1:].view(n_rows, T)
+        self.x = x[process_rank::num_processes].contiguous().to(device) # inputs (contiguous: a strided view stays one on cpu)
+        self.y = y[process_rank::num_processes].contiguous().to(device) # targets
+        if master_process:
+            print(f"val set: {n_rows} rows of {T} tokens, {len(self.x)} on this rank")
+
+    def batches(self, batch_size):
+        for i in range(0, len(self.x), batch_size):
+            yield self.x[i:i+batch_size], self.y[i:i+batch_size]
@@ -0,0 +1,173 @@
+# scores checkpoints from log/ on val loss (and optionally HellaSwag) outside of training,
+# e.g. on a spare cpu box, with whatever batch size fits there
+# python eval_checkpoint.py                                  # every checkpoint in log/
+# python eval_checkpoint.py --checkpoint log/model_05000.pt --hellaswag
+# torchrun --standalone --nproc_per_node=4 eval_checkpoint.py --hellaswag   # split the work over ranks
+# with --watch it's the eval worker of a run with async_eval on: it polls log/ for the eval
+# snapshots (and checkpoints) training writes, scores each step once as it shows up and
+# appends the results to metrics.bin, the same "val" / "hella" records training would write
+# python eval_checkpoint.py --watch --hellaswag --samples --until 19072
+import argparse
+import os
+import time
+import tiktoken
+import torch
+import torch.distributed as dist
+from torch.distributed import init_process_group, destroy_process_group
+
+from gpt import GPT, GPTConfig # GPTConfig has to be importable to unpickle checkpoint['config']
+from dataloader import ValSet
+from evals import HellaSwagEval, evaluate_val_loss
+from checkpoint import list_checkpoints, list_snapshots, load_checkpoint, load_snapshot
+from metrics import MetricsWriter, read_metrics
+from sampling import generate_stream
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--log_dir", type=str, default="log")
+parser.add_argument("--checkpoint", type=str, default=None, help="a single checkpoint, default: all of log_dir")
+parser.add_argument("--batch_size", type=int, default=16, help="rows of T tokens per val forward")
+# val_loss_steps * B * T * world_size of the 8 gpu training run, so the numbers match its log
+parser.add_argument("--val_tokens", type=int, default=20 * 64 * 1024 * 8)
+parser.add_argument("--T", type=int, default=1024)
+parser.add_argument("--hellaswag", action="store_true")
+parser.add_argument("--samples", action="store_true", help="also print a few sampled completions")
+parser.add_argument("--threads", type=int, default=0, help="torch cpu threads per rank, 0 = torch default")
+parser.add_argument("--watch", action="store_true", help="keep polling log_dir for new snapshots / checkpoints")
+parser.add_argument("--poll", type=float, default=10.0, help="seconds between polls with --watch")
+parser.add_argument("--until", type=int, default=None, help="with --watch, exit once this step is scored (the run's last)")
+parser.add_argument("--out", type=str, default=None, help="metrics file in log_dir to append to, default eval.bin (metrics.bin with --watch)")
+args = parser.parse_args()
+
+ddp = int(os.environ.get('RANK', -1)) != -1
+if ddp:
+    ddp_rank = int(os.environ['RANK'])
+    ddp_local_rank = int(os.environ['LOCAL_RANK'])
+    ddp_world_size = int(os.environ['WORLD_SIZE'])
+    if torch.cuda.is_available():
+        init_process_group(backend='nccl')
+        device = f"cuda:{ddp_local_rank}"
+        torch.cuda.set_device(device)
+    else:
+        init_process_group(backend='gloo')
+        device = "cpu"
+else:
+    ddp_rank = 0
+    ddp_world_size = 1
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+master_process = ddp_rank == 0
+device_type = 'cuda' if 'cuda' in device else 'cpu'
+if args.threads > 0:
+    torch.set_num_threads(args.threads)
+
+val_set = ValSet(num_tokens=args.val_tokens, T=args.T, process_rank=ddp_rank,
+                 num_processes=ddp_world_size, device=device)
+hella_eval = HellaSwagEval("val", process_rank=ddp_rank, num_processes=ddp_world_size) if args.hellaswag else None
+eval_file = os.path.join(args.log_dir, args.out or ("metrics.bin" if args.watch else "eval.bin"))
+enc = tiktoken.get_encoding("gpt2")
+
+def load(path):
+    # a snapshot or a checkpoint -> (step, model on device)
+    checkpoint = load_snapshot(path) if os.path.basename(path).startswith("snapshot_") else load_checkpoint(path)
+    model = GPT.from_state_dict(checkpoint['config'], checkpoint['model'])
+    model.to(device)
+    model.eval()
+    return checkpoint['step'], model
+
+def score(model, step):
+    # the evals of the training loop -> {metric name: value}
+    val_loss_sum, val_count = evaluate_val_loss(model, val_set, args.batch_size, device_type)
+    if ddp:
+        dist.all_reduce(val_loss_sum, op=dist.ReduceOp.SUM)
+        dist.all_reduce(val_count, op=dist.ReduceOp.SUM)
+    val_loss = (val_loss_sum / val_count).item()
+    results = {"val": val_loss}
+
+    if hella_eval is not None:
+        num_correct_norm, num_total = hella_eval.evaluate(model, device, device_type)
+        if ddp:
+            stats = torch.tensor([num_correct_norm, num_total], dtype=torch.long, device=device)
+            dist.all_reduce(stats, op=dist.ReduceOp.SUM)
+            num_correct_norm, num_total = stats.tolist()
+        results["hella"] = num_correct_norm / num_total
+
+    if args.samples and master_process:
+        tokens = enc.encode("Hello, I'm a language model,")
+        completions = [[] for _ in range(4)]
+        for next_tokens in generate_stream(model, [tokens] * 4, 32 - len(tokens), device, top_k=50, seeds=[42, 43, 44, 45]):
+            for completion, token in zip(completions, next_tokens):
+                completion.append(token)
+        for i, completion in enumerate(completions):
+            print(f"step {step} sample {i}: {enc.decode(tokens + completion)}")
+    return results
+
+def scored_steps():
+    # steps that already have a val record in eval_file, so a restarted worker doesn't redo them
+    if not os.path.exists(eval_file):
+        return set()
+    steps, _ = read_metrics(eval_file).get("val", ([], []))
+    return set(int(step) for step in steps)
+
+def record(path, step, results):
+    print(f"{path}: " + ", ".join(f"{name} {value:.4f}" for name, value in results.items()))
+    for name, value in results.items():
+        eval_metrics.log(step, name, value)
+    eval_metrics.flush()
+
+def pending(done):
+    # (step, path) to score next, oldest first. a step with both keeps the checkpoint
+    paths = dict(list_snapshots(args.log_dir))
+    paths.update(list_checkpoints(args.log_dir))
+    return sorted((step, path) for step, path in paths.items() if step not in done)
+
+if args.checkpoint is not None:
+    checkpoint_paths = [args.checkpoint]
+else:
+    checkpoint_paths = [path for _, path in list_checkpoints(args.log_dir)]
+
+eval_metrics = MetricsWriter(eval_file) if master_process else None
+if not args.watch:
+    for checkpoint_path in checkpoint_paths:
+        step, model = load(checkpoint_path)
+        results = score(model, step)
+        del model
+        if master_process:
+            record(checkpoint_path, step, results)
+else:
+    done = scored_steps()
+    while True:
+        # rank 0 decides what to score, so all ranks take part in the same all_reduces
+        todo = [pending(done)]
+        if ddp:
+            dist.broadcast_object_list(todo, src=0)
+        todo = todo[0]
+        if not todo:
+            time.sleep(args.poll)
+            continue
+        step, path = todo[0]
+        # training prunes snapshots (and checkpoints) it keeps no more of, this one may be gone
+        try:
+            _, model = load(path)
+            loaded = torch.tensor(1, device=device)
+        except FileNotFoundError:
+            model, loaded = None, torch.tensor(0, device=device)
+        if ddp:
+            dist.all_reduce(loaded, op=dist.ReduceOp.MIN) # skip it together, or not at all
+        if loaded.item() == 0:
+            if master_process:
+                print(f"{path} was removed before it was scored, skipping step {step}")
+            done.add(step)
+            continue
+        results = score(model, step)
+        del model
+        done.add(step)
+        if master_process:
+            record(path, step, results)
+            if os.path.basename(path).startswith("snapshot_"):
+                os.remove(path) # scored, the snapshot has no other use
+        if args.until is not None and step >= args.until:
+            break
+
+if master_process:
+    eval_metrics.close()
+if ddp:
+    destroy_process_group()
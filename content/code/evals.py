@@ -0,0 +1,151 @@
+import os
+import torch
+from torch.nn import functional as F
+
+from hellaswag import render_example, iterate_examples
+
+# same as the training script: rank 0 of a torchrun job, or no ddp at all
+master_process = int(os.environ.get('RANK', 0)) == 0
+
+# -----------------------------------------------------------------------------
+# validation loss
+
+@torch.no_grad()
+def evaluate_val_loss(model, val_set, batch_size, device_type, autocast=True):
+    # returns (sum of per-token losses, number of tokens) for this rank's share of the
+    # val set as tensors, so ranks can all_reduce both with SUM and divide.
+    # autocast=False scores in the model's own dtype (fp32) instead of bf16
+    loss_sum = torch.zeros((), dtype=torch.float32, device=val_set.x.device)
+    count = torch.zeros((), dtype=torch.float32, device=val_set.x.device)
+    for x, y in val_set.batches(batch_size):
+        with torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=autocast):
+            logits, loss = model(x, y)
+        loss_sum += loss.float() * y.numel()
+        count += y.numel()
+    return loss_sum, count
+
+# -----------------------------------------------------------------------------
+# helper function for HellaSwag eval
+# takes tokens, mask, and logits, returns the index of the lowest loss completion per example
+
+def get_most_likely_rows(tokens, mask, logits):
+    # evaluate the autoregressive loss at all positions, average it over the completion
+    # region (mask == 1) of each row: the completion with the lowest loss is the prediction.
+    # tokens, mask are (E, 4, T), logits are (E*4, T, vocab_size), returns (E,) predictions
+    E, N, T = tokens.size()
+    shift_logits = (logits[..., :-1, :]).contiguous()
+    shift_tokens = (tokens.view(E * N, T)[..., 1:]).contiguous()
+    flat_shift_logits = shift_logits.view(-1, shift_logits.size(-1))
+    flat_shift_tokens = shift_tokens.view(-1)
+    shift_losses = F.cross_entropy(flat_shift_logits, flat_shift_tokens, reduction='none')
+    shift_losses = shift_losses.view(E, N, -1)
+    shift_mask = (mask[..., 1:]).contiguous()
+    masked_shift_losses = shift_losses * shift_mask
+    sum_loss = masked_shift_losses.sum(dim=-1)
+    avg_loss = sum_loss / shift_mask.sum(dim=-1) # (E, 4)
+    pred_norm = avg_loss.argmin(dim=-1)
+    return pred_norm
+
+def split_context(tokens, mask):
+    # turn rendered rows (shared context + ending, right-padded) back into the inputs of
+    # GPT.score_completions. tokens, mask are (E, N, T), the context is everything before
+    # the first 1 in the mask and is identical across the N rows of an example
+    E, N, T = tokens.size()
+    ctx_lengths = mask[:, 0].argmax(dim=-1) # (E,) index of the first completion token
+    ending_lengths = mask.sum(dim=-1) # (E, N)
+    Te = ending_lengths.max().item()
+    ctx = tokens[:, 0, :ctx_lengths.max().item()]
+    offsets = ctx_lengths[:, None, None] + torch.arange(Te, device=tokens.device)[None, None, :]
+    endings = tokens.gather(2, offsets.clamp(max=T - 1).expand(E, N, Te)) # (E, N, Te), tail is padding
+    return ctx, ctx_lengths, endings, ending_lengths
+
+class HellaSwagEval:
+    # renders + tokenizes a HellaSwag split once and caches it on disk as one tensor file,
+    # then scores this rank's share of examples in length-bucketed padded batches
+    # instead of one tiny 4-row forward per example.
+    # rows are right-padded (as render_example already does within an example) so padding
+    # never changes the logits of real positions, and the mask keeps it out of the loss.
+    # with shared_context the context of each example is forwarded once and the 4 endings
+    # are scored off its kv cache (GPT.score_completions), rather than 4 full rows.
+    # with len_buckets every batch is padded to one of those lengths (for compiled.py)
+
+    def __init__(self, split, process_rank, num_processes, max_tokens=16384, shared_context=True, len_buckets=None):
+        self.split = split
+        self.shared_context = shared_context
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hellaswag")
+        cache_path = os.path.join(cache_dir, f"hellaswag_{split}_tokens.pt")
+        if os.path.exists(cache_path):
+            data = torch.load(cache_path)
+        else:
+            data = self.render_split(split)
+            if master_process:
+                os.makedirs(cache_dir, exist_ok=True)
+                torch.save(data, cache_path + ".tmp")
+                os.replace(cache_path + ".tmp", cache_path) # so a half written cache is never picked up
+        self.tokens = data['tokens'] # (N, 4, max_len) int32, right-padded with 0
+        self.mask = data['mask'] # (N, 4, max_len) uint8, 1 on the completion tokens
+        self.lengths = data['lengths'] # (N,) padded length of each example
+        self.labels = data['labels'] # (N,)
+
+        # only process examples where i % num_processes == process_rank (same split as before)
+        # longest first, then pack as many examples as fit in max_tokens per forward
+        idx = torch.arange(process_rank, len(self.labels), num_processes)
+        idx = idx[torch.argsort(self.lengths[idx], descending=True)]
+        self.batches = []
+        start = 0
+        while start < len(idx):
+            L = self.lengths[idx[start]].item()
+            if len_buckets is not None:
+                # a batch only takes examples of one bucket, so short ones aren't padded far
+                Lb = next((b for b in len_buckets if b >= L), L)
+                lo = max([b for b in len_buckets if b < Lb], default=0)
+                n = max(1, max_tokens // (4 * Lb))
+                n = min(n, (self.lengths[idx[start:]] > lo).sum().item())
+                L = min(Lb, self.tokens.size(2)) # the model pads the rest of the way
+            else:
+                n = max(1, max_tokens // (4 * L))
+            self.batches.append((idx[start:start+n], L))
+            start += n
+
+    @staticmethod
+    def render_split(split):
+        rendered = []
+        for example in iterate_examples(split):
+            _, tokens, mask, label = render_example(example)
+            rendered.append((tokens, mask, label))
+        max_len = max(tokens.size(1) for tokens, _, _ in rendered)
+        N = len(rendered)
+        data = {
+            'tokens': torch.zeros((N, 4, max_len), dtype=torch.int32),
+            'mask': torch.zeros((N, 4, max_len), dtype=torch.uint8),
+            'lengths': torch.zeros(N, dtype=torch.long),
+            'labels': torch.zeros(N, dtype=torch.long),
+        }
+        for i, (tokens, mask, label) in enumerate(rendered):
+            L = tokens.size(1)
+            data['tokens'][i, :, :L] = tokens
+            data['mask'][i, :, :L] = mask
+            data['lengths'][i] = L
+            data['labels'][i] = label
+        return data
+
+    def evaluate(self, model, device, device_type, autocast=True):
+        # returns (num_correct_norm, num_total) for this rank. autocast as in evaluate_val_loss
+        num_correct_norm = 0
+        num_total = 0
+        for idx, L in self.batches:
+            tokens = self.tokens[idx, :, :L].to(device).long() # (E, 4, L)
+            mask = self.mask[idx, :, :L].to(device).long()
+            E = tokens.size(0)
+            with torch.no_grad():
+                if self.shared_context:
+                    with torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=autocast):
+                        avg_loss = model.score_completions(*split_context(tokens, mask))
+                    pred_norm = avg_loss.argmin(dim=-1)
+                else:
+                    with torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=autocast):
+                        logits, loss = model(tokens.view(E * 4, L))
+                    pred_norm = get_most_likely_rows(tokens, mask, logits)
+            num_total += E
+            num_correct_norm += (pred_norm == self.labels[idx].to(device)).sum().item()
+        return num_correct_norm, num_total
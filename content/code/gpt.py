@@ -0,0 +1,560 @@
+from dataclasses import dataclass
+import inspect
+import os
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
+
+# same as the training script: rank 0 of a torchrun job, or no ddp at all
+master_process = int(os.environ.get('RANK', 0)) == 0
+
+# where GPT.from_pretrained keeps the converted openai weights
+pretrained_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "nanogpt")
+
+# ---------------------------------------------------------------
+class KVCache:
+    # per-layer key/value buffers for incremental decoding. with a cache, each
+    # decode step only forwards the newest token instead of the whole sequence:
+    # the keys/values of earlier positions are read back from here.
+    # pos is the number of positions already cached (= position offset of the next token)
+
+    def __init__(self, config, batch_size, max_len=None):
+        self.config = config
+        self.n_layer = config.n_layer
+        self.batch_size = batch_size
+        self.n_head = config.n_head
+        self.head_size = config.n_embd // config.n_head
+        self.max_len = max_len or config.block_size
+        self.k = None # (n_layer, B, nh, max_len, hs), allocated lazily on first use
+        self.v = None # so they pick up the device and the autocast dtype of the model
+        self.pos = 0
+        # optional (B, max_len) bool of the cached slots each row may attend to, for rows
+        # whose cached prefix is right-padded. None = every cached slot is real
+        self.valid = None
+        # optional per-row mode, for continuous batching where every row is its own sequence:
+        # row b has lengths[b] tokens cached and its new tokens are written right after them.
+        # set through set_lengths(), which also keeps the max on the host so that no layer
+        # has to sync with the device to find out how much of the cache to attend over
+        self.lengths = None
+        self.max_length = 0
+        # per-row mode: if set, attend over this many slots instead of max_length + T (the
+        # slots past each row's length are masked anyway). compiled.py sets it to a few
+        # bucket sizes so a compiled decode step isn't specialized on the current length
+        self.attend_len = None
+
+    def _alloc(self, dtype, device):
+        shape = (self.n_layer, self.batch_size, self.n_head, self.max_len, self.head_size)
+        self.k = torch.zeros(shape, dtype=dtype, device=device)
+        self.v = torch.zeros(shape, dtype=dtype, device=device)
+
+    def set_lengths(self, lengths, device):
+        self.lengths = torch.tensor(lengths, dtype=torch.long, device=device)
+        self.max_length = max(lengths)
+
+    def update(self, layer, k, v):
+        # write the new keys/values of this layer at the current offset,
+        # return everything cached so far (including the new ones)
+        T = k.size(2)
+        if self.k is None:
+            self._alloc(k.dtype, k.device)
+        if self.lengths is not None:
+            slots = self.lengths[:, None] + torch.arange(T, device=k.device) # (B, T)
+            rows = torch.arange(self.batch_size, device=k.device)[:, None]
+            self.k[layer][rows, :, slots] = k.transpose(1, 2) # (B, T, nh, hs)
+            self.v[layer][rows, :, slots] = v.transpose(1, 2)
+            L = self._attend_len(T)
+            return self.k[layer, :, :, :L], self.v[layer, :, :, :L]
+        assert self.pos + T <= self.max_len, f"kv cache full: {self.pos} + {T} > {self.max_len}"
+        self.k[layer, :, :, self.pos:self.pos+T] = k
+        self.v[layer, :, :, self.pos:self.pos+T] = v
+        if self.valid is not None:
+            self.valid[:, self.pos:self.pos+T] = True
+        return self.k[layer, :, :, :self.pos+T], self.v[layer, :, :, :self.pos+T]
+
+    def _attend_len(self, T):
+        if self.attend_len is not None:
+            return self.attend_len
+        assert self.max_length + T <= self.max_len, f"kv cache full: {self.max_length} + {T} > {self.max_len}"
+        return self.max_length + T
+
+    def attn_mask(self, T):
+        # mask for T new queries against the cache (which already holds them), None = plain causal
+        if self.lengths is not None:
+            # every row attends to its own cached tokens, up to and including each query
+            L = self._attend_len(T)
+            ends = self.lengths[:, None] + torch.arange(T, device=self.k.device) # (B, T)
+            mask = torch.arange(L, device=self.k.device)[None, None, :] <= ends[:, :, None]
+            return mask[:, None] # (B, 1, T, L)
+        L = self.pos + T
+        if self.pos == 0 and self.valid is None:
+            return None
+        # the queries sit at the end of the cached sequence: each one sees every
+        # cached position plus the new positions up to and including itself
+        mask = torch.ones(T, L, dtype=torch.bool, device=self.k.device).tril(diagonal=L - T)
+        if self.valid is not None:
+            mask = mask & self.valid[:, None, None, :L] # (B, 1, T, L)
+        return mask
+
+    def repeat_interleave(self, n):
+        # a cache holding n copies of every row, to branch n continuations off each cached prefix
+        cache = KVCache(self.config, self.batch_size * n, self.max_len)
+        cache.k = self.k.repeat_interleave(n, dim=1)
+        cache.v = self.v.repeat_interleave(n, dim=1)
+        if self.valid is not None:
+            cache.valid = self.valid.repeat_interleave(n, dim=0)
+        cache.pos = self.pos
+        return cache
+
+    def copy_row(self, row, src, src_row=0):
+        # copy the cached prefix of row src_row of another cache into our row (per-row mode),
+        # e.g. a prompt that was prefilled on its own joining a running batch
+        if self.k is None:
+            self._alloc(src.k.dtype, src.k.device)
+        n = src.pos
+        self.k[:, row, :, :n] = src.k[:, src_row, :, :n]
+        self.v[:, row, :, :n] = src.v[:, src_row, :, :n]
+
+    @torch.compiler.disable # host-side bookkeeping, a compiled graph must not specialize on it
+    def advance(self, T):
+        # called by GPT.forward once all layers have written their T new positions
+        if self.lengths is not None:
+            self.lengths += T
+            self.max_length += T
+        else:
+            self.pos += T
+
+    def reset(self):
+        self.pos = 0
+        self.lengths = None
+        self.max_length = 0
+
+class CausalSelfAttention(nn.Module):
+
+    def __init__(self, config):
+        super().__init__()
+        assert config.n_embd % config.n_head == 0
+        # key, query, value projections for all heads, but in a batch
+        self.c_attn = nn.Linear(config.n_embd, 3 * config.n_embd)
+        # output projection
+        self.c_proj = nn.Linear(config.n_embd, config.n_embd)
+        self.c_proj.NANOGPT_SCALE_INIT = 1 # normalize residual stream
+        # regularization
+        self.n_head = config.n_head
+        self.n_embd = config.n_embd
+        # no causal mask buffer: sdpa's is_causal (or the kv cache's mask) does the masking
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints still carry the block_size x block_size mask openai called
+        # "bias", drop it so they load as they are
+        state_dict.pop(prefix + 'bias', None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x, kv_cache=None, layer=0):
+        B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd) - size returns tuple of shapes
+        # calculate query, key, values for all heads in batch and move head forward to be the batch dim
+        # nh is "number of heads", hs is "head size", and C (number of channels) = nh * hs
+        # e.g. in GPT-2 (124M), n_head=12, hs=64, so nh*hs=C=768 channels in the Transformer
+        qkv = self.c_attn(x)
+        q, k, v = qkv.split(self.n_embd, dim=2)
+        # these 3 view operations move the heads to the second dimension so they
+        # are computed in parallel. this is the internal of pt: first 2 dimensions
+        # are auto computed in parallel
+        k = k.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
+        q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
+        v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
+
+        mask = None
+        if kv_cache is not None:
+            k, v = kv_cache.update(layer, k, v) # (B, nh, pos + T, hs)
+            mask = kv_cache.attn_mask(T)
+
+        if mask is None:
+            y = F.scaled_dot_product_attention(q, k, v, is_causal=True) # flash attention
+        else:
+            y = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+
+        y = y.transpose(1, 2).contiguous().view(B, T, C) # re-assemble all head outputs side by side
+        # output projection
+        y = self.c_proj(y)
+        return y
+
+
+
+class MLP(nn.Module):
+
+    def __init__(self,config):
+        super().__init__()
+        self.c_fc = nn.Linear(config.n_embd, 4 * config.n_embd)
+        # gaussian error linear units
+        # a slightly smoother relu
+        # transformers seem to prefer smooth activations of sharper ones (like relu)
+        self.gelu = nn.GELU(approximate='tanh') # historical quirk to use approximate tanh
+        self.c_proj = nn.Linear(4 * config.n_embd, config.n_embd)
+        self.c_proj.NANOGPT_SCALE_INIT = 1 # normalize residual stream
+
+
+    def forward(self, x):
+        x = self.c_fc(x)
+        x = self.gelu(x)
+        x = self.c_proj(x)
+        return x
+
+class Block(nn.Module):
+
+    def __init__(self,config):
+        super().__init__()
+        self.ln_1 = nn.LayerNorm(config.n_embd)
+        self.attn = CausalSelfAttention(config)
+        self.ln_2 = nn.LayerNorm(config.n_embd)
+        self.mlp = MLP(config)
+        # activation checkpointing: None keeps everything for backward, "block" keeps only
+        # the block's input and recomputes the rest in backward, "mlp" does that for the mlp
+        self.recompute = None
+
+    def forward(self, x, kv_cache=None, layer=0):
+        recompute = self.recompute if torch.is_grad_enabled() and kv_cache is None else None
+        if recompute == "block":
+            return checkpoint(self._forward, x, use_reentrant=False)
+        x = x + self.attn(self.ln_1(x), kv_cache, layer)
+        if recompute == "mlp":
+            return x + checkpoint(self._mlp, x, use_reentrant=False)
+        x = x + self.mlp(self.ln_2(x))
+        return x
+
+    def _forward(self, x):
+        x = x + self.attn(self.ln_1(x))
+        return x + self._mlp(x)
+
+    def _mlp(self, x):
+        return self.mlp(self.ln_2(x))
+
+class ChunkedCrossEntropy(torch.autograd.Function):
+    # lm_head + cross entropy over chunks of tokens, so the (B*T, vocab_size) logits never
+    # exist all at once (at B=64, T=1024 that's 3.3B elements, plus as many for their grad).
+    # all backward needs from the logits is softmax - onehot, so the grads w.r.t. x and the
+    # lm_head weight are computed chunk by chunk right here in the forward, and backward
+    # only scales them by the incoming grad (1/grad_accum_steps)
+
+    @staticmethod
+    def forward(ctx, x, weight, targets, chunk_size, ignore_index=-100):
+        shape = x.shape
+        x = x.reshape(-1, shape[-1]) # (N, C)
+        targets = targets.reshape(-1) # (N,)
+        valid = targets != ignore_index
+        n_valid = valid.sum().clamp(min=1)
+        loss = torch.zeros((), dtype=torch.float32, device=x.device)
+        grad_x = torch.empty_like(x)
+        grad_weight = torch.zeros_like(weight, dtype=torch.float32)
+        for i in range(0, x.size(0), chunk_size):
+            x_c, v_c = x[i:i+chunk_size], valid[i:i+chunk_size]
+            t_c = torch.where(v_c, targets[i:i+chunk_size], 0)
+            logits = F.linear(x_c, weight) # (chunk, vocab_size), bf16 under autocast
+            logits_f = logits.float() # the loss itself in fp32, like F.cross_entropy under autocast
+            lse = torch.logsumexp(logits_f, dim=-1)
+            loss += ((lse - logits_f.gather(1, t_c[:, None]).squeeze(1)) * v_c).sum()
+            # d loss / d logits of the mean loss: (softmax - onehot) / n_valid, 0 for ignored rows
+            grad_logits = torch.exp(logits_f - lse[:, None])
+            grad_logits[torch.arange(t_c.size(0), device=x.device), t_c] -= 1
+            grad_logits *= (v_c / n_valid)[:, None]
+            grad_logits = grad_logits.to(logits.dtype)
+            grad_x[i:i+chunk_size] = grad_logits @ weight
+            grad_weight += (grad_logits.t() @ x_c).float()
+        ctx.save_for_backward(grad_x, grad_weight)
+        ctx.shape = shape
+        ctx.weight_dtype = weight.dtype
+        return loss / n_valid
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        grad_x, grad_weight = ctx.saved_tensors
+        grad_x = (grad_x * grad_loss).view(ctx.shape)
+        grad_weight = (grad_weight * grad_loss).to(ctx.weight_dtype)
+        return grad_x, grad_weight, None, None, None
+
+
+@dataclass
+class GPTConfig:
+    block_size: int = 1024 # max sequence length
+    vocab_size: int = 50257 # number of toks: 50k bpe merges, 256 bytes tokens, 1 <eos> token
+    # 50257 is ugly. odd. we want powers of 2.
+    # 50304 is divisible by 8, 16. better.
+    n_layer: int = 12
+    n_head: int = 12
+    n_embd: int = 768
+    bias: bool = True # True: bias in Linears and LayerNorms, like GPT-2. False: a bit better and faster
+
+class GPT(nn.Module):
+    def __init__(self,config):
+        super().__init__()
+        self.config = config
+
+        self.transformer = nn.ModuleDict(dict(
+            wte = nn.Embedding(config.vocab_size, config.n_embd),
+            wpe = nn.Embedding(config.block_size, config.n_embd),
+            h = nn.ModuleList([Block(config) for _ in range(config.n_layer)]), # h stands for hidden
+            ln_f = nn.LayerNorm(config.n_embd), # final layer norm
+        ))
+        self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False) # final classifier
+        # with targets, the logits are computed this many tokens at a time and not returned
+        # (peak memory for the loss goes from B*T*vocab_size to this*vocab_size). 0 = off
+        self.loss_chunk_size = 4096
+
+        # weight sharing
+        self.transformer.wte.weight = self.lm_head.weight
+
+        # init params
+        self.apply(self._init_weights)
+
+    def _init_weights(self, module):
+        if isinstance(module, nn.Linear):
+            std = 0.02
+            if hasattr(module, 'NANOGPT_SCALE_INIT'):
+                std *= (2 * self.config.n_layer) ** -0.5 # 1 over square root of num_layers,
+               # keeps residual stream from ballooning
+               # it's 2x bc attn and ffn both add to the residual pathway
+            torch.nn.init.normal_(module.weight, mean=0.0, std=std)
+            if module.bias is not None:
+                torch.nn.init.zeros_(module.bias)
+        elif isinstance(module, nn.Embedding):
+            torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
+
+    @classmethod
+    def from_state_dict(cls, config, state_dict):
+        # build the modules on the meta device (no memory, no init) and take the tensors of
+        # state_dict as the weights, instead of initializing weights only to overwrite them.
+        # the tensors are used as they are: a mmapped checkpoint is only read in by .to(device)
+        with torch.device('meta'):
+            model = cls(config)
+        model.load_state_dict(state_dict, assign=True)
+        model.transformer.wte.weight = model.lm_head.weight # assign replaced both, tie them again
+        return model
+
+    @classmethod
+    def from_pretrained(cls, model_type, override_args=None):
+        assert model_type in {'gpt2', 'gpt2-medium', 'gpt2-large', 'gpt2-xl'}
+        override_args = override_args or {} # default to empty dict
+        # only dropout can be overridden see more notes below
+        assert all(k == 'dropout' for k in override_args)
+        print("loading weights from pretrained gpt: %s" % model_type)
+
+        # n_layer, n_head and n_embd are determined from model_type
+        config_args = {
+            'gpt2':         dict(n_layer=12, n_head=12, n_embd=768),  # 124M params
+            'gpt2-medium':  dict(n_layer=24, n_head=16, n_embd=1024), # 350M params
+            'gpt2-large':   dict(n_layer=36, n_head=20, n_embd=1280), # 774M params
+            'gpt2-xl':      dict(n_layer=48, n_head=25, n_embd=1600), # 1558M params
+        }[model_type]
+        print("forcing vocab_size=50257, block_size=1024, bias=True")
+        config_args['vocab_size'] = 50257 # always 50257 for GPT model checkpoints
+        config_args['block_size'] = 1024 # always 1024 for GPT model checkpoints
+        config_args['bias'] = True # always True for GPT model checkpoints
+        # we can override the dropout rate, if desired
+        if 'dropout' in override_args:
+            print(f"overriding dropout rate to {override_args['dropout']}")
+            config_args['dropout'] = override_args['dropout']
+        config = GPTConfig(**config_args)
+        # the shapes to expect, from a model on the meta device (nothing gets allocated)
+        with torch.device('meta'):
+            sd = GPT(config).state_dict()
+        sd_keys = list(sd.keys())
+
+        # after the first import the converted weights are cached locally: from then on
+        # loading is a single mmap, no transformers / safetensors / hub involved
+        cache_path = os.path.join(pretrained_cache_dir, f"{model_type}.pt")
+        if os.path.exists(cache_path):
+            sd_cached = torch.load(cache_path, map_location='cpu', mmap=True, weights_only=True)
+            assert set(sd_cached.keys()) == set(sd_keys), f"stale cache {cache_path}, delete it"
+            return cls.from_state_dict(config, sd_cached)
+
+        # read the huggingface checkpoint tensor by tensor from its (memory-mapped) safetensors
+        # file, instead of building a whole GPT2LMHeadModel next to ours: at peak we hold the
+        # converted weights plus one tensor, not two full models (~13GB for gpt2-xl)
+        from huggingface_hub import hf_hub_download
+        from safetensors import safe_open
+        hf_path = hf_hub_download(model_type, "model.safetensors")
+
+        # copy while ensuring all of the parameters are aligned and match in names and shapes
+        transposed = ['attn.c_attn.weight', 'attn.c_proj.weight', 'mlp.c_fc.weight', 'mlp.c_proj.weight']
+        # basically the openai checkpoints use a "Conv1D" module, but we only want to use a vanilla Linear
+        # this means that we have to transpose these weights when we import them
+        weights = {}
+        with safe_open(hf_path, framework="pt") as f:
+            for k_hf in f.keys():
+                if k_hf.endswith('.attn.masked_bias') or k_hf.endswith('.attn.bias'):
+                    continue # just the mask (buffer)
+                # the hub files store the GPT2Model weights, without the "transformer." prefix
+                k = k_hf if k_hf.startswith(('transformer.', 'lm_head.')) else 'transformer.' + k_hf
+                w_hf = f.get_tensor(k_hf)
+                if any(k.endswith(w) for w in transposed):
+                    # special treatment for the Conv1D weights we need to transpose
+                    assert w_hf.shape[::-1] == sd[k].shape
+                    w_hf = w_hf.t().contiguous()
+                else:
+                    # vanilla copy over the other parameters
+                    assert w_hf.shape == sd[k].shape
+                weights[k] = w_hf
+        weights['lm_head.weight'] = weights['transformer.wte.weight'] # tied, whether or not the file has its own copy
+        assert set(weights) == set(sd_keys), f"mismatched keys: {sorted(set(sd_keys) ^ set(weights))}"
+
+        os.makedirs(pretrained_cache_dir, exist_ok=True)
+        torch.save(weights, cache_path + ".tmp")
+        os.replace(cache_path + ".tmp", cache_path)
+        return cls.from_state_dict(config, weights)
+
+    def forward(self, idx, targets=None, kv_cache=None, last_only=False, positions=None):
+        # kv_cache: a KVCache, idx then holds only the tokens that come after the cached ones
+        # last_only: only compute the logits of the final position (all sampling needs)
+        # positions: (B, T) per-row positions, for rows that continue a right-padded cached prefix
+        B, T = idx.size()
+        start = kv_cache.pos if kv_cache is not None else 0 # position offset of idx
+        assert start + T <= self.config.block_size, f"Cannot fwd seq of length {start + T}, block size {self.config.block_size}"
+
+        if positions is not None:
+            pos = positions # shape (B, T)
+        elif kv_cache is not None and kv_cache.lengths is not None:
+            pos = kv_cache.lengths[:, None] + torch.arange(T, dtype=torch.long, device=idx.device) # (B, T), each row at its own offset
+        else:
+            pos = torch.arange(start, start + T, dtype=torch.long, device=idx.device) # shape (T)
+        pos_emb = self.transformer.wpe(pos) # pos embs of shape (T, n_embd)
+        tok_emb = self.transformer.wte(idx) # token embs of shape (B, T, n_embd)
+        x = tok_emb + pos_emb
+
+        for i, block in enumerate(self.transformer.h):
+            x = block(x, kv_cache, i)
+        if kv_cache is not None:
+            kv_cache.advance(T)
+
+        x = self.transformer.ln_f(x)
+        if targets is not None and self.loss_chunk_size > 0 and not last_only:
+            if torch.is_grad_enabled():
+                loss = ChunkedCrossEntropy.apply(x, self.lm_head.weight, targets, self.loss_chunk_size)
+            else:
+                # eval: nothing to backprop, just sum up the loss chunk by chunk
+                x, targets = x.view(-1, x.size(-1)), targets.reshape(-1)
+                loss = sum(F.cross_entropy(self.lm_head(x[i:i+self.loss_chunk_size]), targets[i:i+self.loss_chunk_size], reduction='sum')
+                           for i in range(0, x.size(0), self.loss_chunk_size))
+                loss = loss / (targets != -100).sum().clamp(min=1)
+            return None, loss
+        if last_only:
+            x = x[:, [-1], :] # skip the lm_head matmul for every position we'd throw away
+        logits = self.lm_head(x) # (B,T, vocab_size)
+        loss = None
+        if targets is not None:
+
+            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.reshape(-1)) # reshape: targets can be a strided slice
+        return logits, loss
+
+    @torch.no_grad()
+    def score_completions(self, ctx, ctx_lengths, endings, ending_lengths):
+        # average per-token loss of N candidate endings for each of E contexts, where the
+        # context goes through the model once and every ending branches off its cached
+        # keys/values, instead of recomputing the (usually much longer) context N times.
+        # ctx: (E, Tc) right-padded contexts, ctx_lengths: (E,)
+        # endings: (E, N, Te) right-padded endings, ending_lengths: (E, N)
+        # returns (E, N), lower = more likely
+        E, N, Te = endings.size()
+        device = ctx.device
+        # the last context token is held back and fed as the first token of every ending
+        # row, its logits predict the first ending token. so the context pass needs no logits
+        Tc = ctx_lengths.max().item() - 1
+        if Tc > 0:
+            kv_cache = KVCache(self.config, E, max_len=Tc + Te)
+            self(ctx[:, :Tc], kv_cache=kv_cache, last_only=True)
+            # the contexts are right-padded: each row may only attend to its own real tokens
+            kv_cache.valid = torch.arange(Tc + Te, device=device)[None, :] < (ctx_lengths[:, None] - 1) # (E, Tc+Te)
+            kv_cache = kv_cache.repeat_interleave(N) # (E*N) rows, N per context
+        else:
+            kv_cache = KVCache(self.config, E * N, max_len=Te) # single token contexts, nothing to share
+        last = ctx.gather(1, (ctx_lengths - 1)[:, None]) # (E, 1)
+        idx = torch.cat((last[:, None, :].expand(E, N, 1), endings[..., :-1]), dim=-1).reshape(E * N, Te)
+        positions = (ctx_lengths - 1)[:, None] + torch.arange(Te, device=device)[None, :] # (E, Te)
+        positions = positions.repeat_interleave(N, dim=0) # (E*N, Te)
+        logits, _ = self(idx, kv_cache=kv_cache, positions=positions) # (E*N, Te, vocab_size)
+        losses = F.cross_entropy(logits.view(-1, logits.size(-1)), endings.reshape(-1), reduction='none')
+        losses = losses.view(E, N, Te)
+        mask = torch.arange(Te, device=device)[None, None, :] < ending_lengths[..., None] # (E, N, Te)
+        avg_loss = (losses * mask).sum(dim=-1) / ending_lengths
+        return avg_loss
+
+    def set_activation_checkpointing(self, mode, every=1):
+        # mode: "none", "block" or "mlp", applied to every `every`-th block (0, every, 2*every, ...)
+        assert mode in ("none", "block", "mlp")
+        for i, block in enumerate(self.transformer.h):
+            block.recompute = mode if mode != "none" and i % every == 0 else None
+
+    def estimate_training_memory(self, B, T, mode="none", every=1, optimizer_shards=1):
+        # rough peak bytes of a bf16 autocast training step, per "Reducing Activation
+        # Recomputation in Large Transformer Models" (Korthikanti et al.): per token and
+        # layer the attention keeps ~13 * n_embd bytes (no T^2 scores with flash attention),
+        # the mlp ~21 * n_embd. a checkpointed part keeps only its fp32 input, and backward
+        # holds the recomputed activations of one part at a time
+        # returns (bytes, recompute flops / training flops)
+        C, L, V = self.config.n_embd, self.config.n_layer, self.config.vocab_size
+        N = sum(p.numel() for p in self.parameters())
+        attn_act, mlp_act, x_act = 13 * C * B * T, 21 * C * B * T, 4 * C * B * T
+        n_ckpt = 0 if mode == "none" else len(range(0, L, every))
+        if mode == "block":
+            act = (L - n_ckpt) * (attn_act + mlp_act) + n_ckpt * x_act + (attn_act + mlp_act if n_ckpt else 0)
+            recompute_flops = n_ckpt * (24 * C * C + 4 * T * C) # attention + mlp forward, per token
+        elif mode == "mlp":
+            act = L * attn_act + (L - n_ckpt) * mlp_act + n_ckpt * x_act + (mlp_act if n_ckpt else 0)
+            recompute_flops = n_ckpt * 16 * C * C
+        else:
+            act = L * (attn_act + mlp_act)
+            recompute_flops = 0
+        chunk = self.loss_chunk_size or B * T
+        logits = 12 * min(chunk, B * T) * V # fp32 logits, their softmax and the bf16 grad
+        state = 8 * N + 8 * N / optimizer_shards # fp32 weights and grads, AdamW's two moments (sharded by ZeRO)
+        train_flops = 6 * N + 12 * L * C * T
+        return state + act + logits, recompute_flops / train_flops
+
+    def plan_activation_checkpointing(self, B, T, budget, optimizer_shards=1):
+        # the setting with the least recompute that fits in `budget` bytes, as a dict of
+        # mode, every, bytes and overhead. if nothing fits, the one that uses the least memory
+        L = self.config.n_layer
+        candidates = [("none", 1)] + [(mode, every) for mode in ("mlp", "block") for every in range(L, 0, -1)]
+        plans = []
+        for mode, every in candidates:
+            nbytes, overhead = self.estimate_training_memory(B, T, mode, every, optimizer_shards)
+            plans.append(dict(mode=mode, every=every, bytes=nbytes, overhead=overhead, fits=nbytes <= budget))
+        fitting = [p for p in plans if p['fits']]
+        if fitting:
+            return min(fitting, key=lambda p: p['overhead'])
+        return min(plans, key=lambda p: p['bytes'])
+
+    def configure_optimizers(self, weight_decay, learning_rate, device_type, fused=None, zero=False): # 2:31:50
+        # this weight decay forces info to go across many smaller channels instead of one big one
+        # start with all of the candidate parameters (that require grad)
+        param_dict = {pn: p for pn, p in self.named_parameters()}
+        param_dict = {pn: p for pn, p in param_dict.items() if p.requires_grad}
+        # create optim groups. Any parameters that is 2D will be weight decayed, otherwise no.
+        # i.e. all weight tensors in matmuls + embeddings decay, all biases and layernorms don't.
+        decay_params = [p for n, p in param_dict.items() if p.dim() >= 2] # decay weights and sometimes embs
+        nodecay_params = [p for n, p in param_dict.items() if p.dim() < 2] # no decay biases and layernorms
+        optim_groups = [
+            {'params': decay_params, 'weight_decay': weight_decay},
+            {'params': nodecay_params, 'weight_decay': 0.0}
+        ]
+        num_decay_params = sum(p.numel() for p in decay_params)
+        num_nodecay_params = sum(p.numel() for p in nodecay_params)
+        if master_process: # this is so if u have gpu clusters it doesn't print 8 times
+            print(f"num decayed parameter tensors: {len(decay_params)}, with {num_decay_params:,} parameters")
+            print(f"num non-decayed parameter tensors: {len(nodecay_params)}, with {num_nodecay_params:,} parameters")
+        # Create AdamW optimizer and use the fused version if it is available
+        fused_available = 'fused' in inspect.signature(torch.optim.AdamW).parameters
+        use_fused = fused_available and device_type == "cuda" if fused is None else fused # None: auto
+        if master_process:
+            print(f"using fused AdamW: {use_fused}") # fused is a newer performance optimization
+        if zero:
+            # ZeRO stage 1: every rank keeps the AdamW moments of only its 1/world_size of the
+            # params and steps those, then broadcasts the updated params to the others.
+            # same param groups and hyperparameters, the AdamW just lives inside
+            from torch.distributed.optim import ZeroRedundancyOptimizer
+            if master_process:
+                print("sharding the optimizer state across ranks (ZeRO-1)")
+            optimizer = ZeroRedundancyOptimizer(optim_groups, optimizer_class=torch.optim.AdamW,
+                                                lr=learning_rate, betas=(0.9, 0.95), eps=1e-8, fused=use_fused)
+        else:
+            optimizer = torch.optim.AdamW(optim_groups, lr=learning_rate, betas=(0.9, 0.95), eps=1e-8, fused=use_fused)
+        return optimizer
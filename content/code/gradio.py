@@ -1,17 +1,26 @@
 import torch, gradio as gr
-from transformers import pipeline
+import tiktoken
+from huggingface_hub import hf_hub_download
 
-pipe = pipeline(
-    "text-generation",
-    model="bathrobe/my-gpt-2",  # your repo id
-    device=0 if torch.cuda.is_available() else -1,
-    truncation=True,
-    pad_token_id=50256,
-)
+from gpt import GPT, GPTConfig
+from serve import InferenceEngine
+
+device = "cuda" if torch.cuda.is_available() else "cpu"
+enc = tiktoken.get_encoding("gpt2")
+
+# the raw state dict the training script uploads at the end of the run
+model = GPT.from_state_dict(GPTConfig(vocab_size=50304), torch.load(hf_hub_download("bathrobe/my-gpt2", "model.pt"), map_location="cpu"))
+model.to(device)
+model.eval()
+# one engine for all users: concurrent requests get decoded together in one batch
+engine = InferenceEngine(model, device, max_batch=8)
 
 def generate(prompt, max_length=100):
-    out = pipe(prompt, max_length=max_length, num_return_sequences=1, truncation=True)
-    return out[0]["generated_text"]
+    # a generator, so gradio streams the output box: the text grows token by token
+    tokens = enc.encode(prompt)
+    for token in engine.stream(tokens, max_length=int(max_length)):
+        tokens.append(token)
+        yield enc.decode(tokens)
 
 prompt_tb = gr.Textbox(
     label="prompt", placeholder="type a prompt…",
@@ -38,4 +47,5 @@ gr.Interface(
     allow_flagging="never",
     theme=gr.themes.Soft(spacing_size="sm", radius_size="sm", text_size="sm"),
     css=css,
+    concurrency_limit=engine.max_batch, # let requests reach the engine together so they share decode steps
 ).launch()
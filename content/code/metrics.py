@@ -0,0 +1,167 @@
+# append-only metrics store: log/metrics.bin replaces the "step train x" / "step val x" /
+# "step hella x" lines of log.txt. records are buffered in memory and appended in blocks,
+# one write per flush instead of an open + write + close every step. a block is
+#   b"MTRC", uint32 payload bytes, then per metric in it:
+#   uint8 name length, name (utf-8), uint32 n, int32 steps[n], float32 values[n]
+# so reading is a handful of np.frombuffer calls per block, and each block goes out in a
+# single os.write on an O_APPEND fd: the eval worker can append to the same file as training.
+# writers never rewrite the file (another one may be mid-write), so a block cut off by a
+# crash stays in it, possibly with other blocks appended after it: the reader checks every
+# block and skips ahead to the next magic past one that doesn't parse. a step written
+# twice (a resumed run redoing the steps after its checkpoint) reads as its last value
+# python metrics.py log/metrics.bin ../../public/data/training_metrics.json   # for the site
+# python metrics.py log/log.txt out.json                                       # old text logs
+import os
+import json
+import struct
+import argparse
+from collections import defaultdict
+import numpy as np
+
+magic = b"MTRC"
+
+class MetricsWriter:
+
+    def __init__(self, path, flush_every=100, truncate=False):
+        self.path = path
+        self.flush_every = flush_every # buffered records before a flush
+        self.buffer = defaultdict(list) # name -> [(step, value)]
+        self.count = 0
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND | (os.O_TRUNC if truncate else 0)
+        self.fd = os.open(path, flags, 0o644)
+
+    def log(self, step, name, value):
+        self.buffer[name].append((step, value))
+        self.count += 1
+        if self.count >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.count == 0:
+            return
+        parts = []
+        for name, records in self.buffer.items():
+            name = name.encode()
+            steps, values = zip(*records)
+            parts.append(struct.pack("<B", len(name)) + name + struct.pack("<I", len(records)))
+            parts.append(np.asarray(steps, dtype="<i4").tobytes())
+            parts.append(np.asarray(values, dtype="<f4").tobytes())
+        payload = b"".join(parts)
+        os.write(self.fd, magic + struct.pack("<I", len(payload)) + payload)
+        self.buffer.clear()
+        self.count = 0
+
+    def close(self):
+        self.flush()
+        os.close(self.fd)
+
+def parse_block(data, pos):
+    # the block at pos -> ([(name, steps, values)], end), or None if it isn't a whole, valid one
+    if data[pos:pos+4] != magic or pos + 8 > len(data):
+        return None
+    (size,) = struct.unpack_from("<I", data, pos + 4)
+    end = pos + 8 + size
+    if end > len(data):
+        return None # cut off (or still being written)
+    entries = []
+    pos += 8
+    while pos < end:
+        (name_len,) = struct.unpack_from("<B", data, pos)
+        if pos + 5 + name_len > end:
+            return None
+        try:
+            name = data[pos+1:pos+1+name_len].decode()
+        except UnicodeDecodeError:
+            return None
+        (n,) = struct.unpack_from("<I", data, pos + 1 + name_len)
+        pos += 5 + name_len
+        if pos + 8 * n > end:
+            return None
+        steps = np.frombuffer(data, dtype="<i4", count=n, offset=pos)
+        values = np.frombuffer(data, dtype="<f4", count=n, offset=pos + 4 * n)
+        entries.append((name, steps, values))
+        pos += 8 * n
+    return entries, end
+
+def read_metrics(path):
+    # -> {name: (steps, values)}, sorted by step, one value per step
+    with open(path, "rb") as f:
+        data = f.read()
+    chunks = defaultdict(list)
+    pos = 0
+    while pos + 8 <= len(data):
+        block = parse_block(data, pos)
+        if block is None:
+            # a cut block: resync at the next block header after it, if any
+            pos = data.find(magic, pos + 1)
+            if pos < 0:
+                break
+            continue
+        entries, pos = block
+        for name, steps, values in entries:
+            chunks[name].append((steps, values))
+    return {name: dedup(np.concatenate([s for s, _ in c]), np.concatenate([v for _, v in c])) for name, c in chunks.items()}
+
+def read_text_log(path):
+    # the old log.txt format, "step name value" per line, into the same shape
+    chunks = defaultdict(list)
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3:
+                chunks[parts[1]].append((int(parts[0]), float(parts[2])))
+    return {name: dedup(np.array([s for s, _ in r], dtype=np.int32), np.array([v for _, v in r], dtype=np.float32))
+            for name, r in chunks.items()}
+
+def dedup(steps, values):
+    # sort by step, the last written value of a step wins
+    order = np.argsort(steps, kind="stable")
+    steps, values = steps[order], values[order]
+    last = np.append(steps[1:] != steps[:-1], True)
+    return steps[last], values[last]
+
+def lttb(x, y, n_out):
+    # largest triangle three buckets (Steinarsson 2013): keeps the first and last point and
+    # from each of n_out - 2 equal buckets in between the point spanning the largest triangle
+    # with the point kept before it and the mean of the next bucket. unlike every-kth-point
+    # it keeps the spikes, which are what you look for in a loss curve
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return x, y
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int) # bucket boundaries over x[1:n-1]
+    keep = [0]
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # mean of the next bucket (the last point for the last bucket)
+        nlo, nhi = hi, edges[i + 2] if i + 2 < len(edges) else n
+        nx, ny = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        ax, ay = x[keep[-1]], y[keep[-1]]
+        area = np.abs((ax - nx) * (y[lo:hi] - ay) - (ax - x[lo:hi]) * (ny - ay))
+        keep.append(lo + int(area.argmax()))
+    keep.append(n - 1)
+    return x[keep], y[keep]
+
+def export_json(metrics, path, points=1000, names=None):
+    # {name: {"step": [...], "value": [...]}}, every series downsampled to at most `points`
+    out = {}
+    for name, (steps, values) in metrics.items():
+        if names is not None and name not in names:
+            continue
+        s, v = lttb(steps.astype(np.float64), values.astype(np.float64), points)
+        out[name] = {"step": s.astype(int).tolist(), "value": [round(float(x), 6) for x in v]}
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(out, f, separators=(",", ":"))
+    return out
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", type=str, help="metrics.bin, or an old log.txt")
+    parser.add_argument("output", type=str)
+    parser.add_argument("--points", type=int, default=1000, help="max points per series")
+    parser.add_argument("--names", type=str, default="train,val,hella", help="comma separated, empty = all")
+    args = parser.parse_args()
+    metrics = read_text_log(args.input) if args.input.endswith(".txt") else read_metrics(args.input)
+    out = export_json(metrics, args.output, args.points, args.names.split(",") if args.names else None)
+    for name, series in out.items():
+        print(f"{name}: {len(metrics[name][0])} -> {len(series['step'])} points")
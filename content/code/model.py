@@ -4,16 +4,19 @@ from torch.nn.parallel import DistributedDataParallel as DDP
 import time
 import torch.distributed as dist
 from datetime import timedelta
-from dataclasses import dataclass
-import inspect
 import math
 import torch
-import torch.nn as nn
-from torch.nn import functional as F
 from torch.optim import optimizer
 import os
 
-from hellaswag import render_example, iterate_examples
+from gpt import GPT, GPTConfig
+from dataloader import RandomAccessLoader, PrefetchLoader, ValSet
+from evals import HellaSwagEval, evaluate_val_loss
+from checkpoint import CheckpointWriter, latest_checkpoint, load_checkpoint
+from profiler import StepProfiler, flops_per_token
+from metrics import MetricsWriter
+from compiled import BucketedGPT, pow2_buckets
+from sampling import generate_stream
 import tiktoken
 enc = tiktoken.get_encoding("gpt2")
 # more forgiving timeouts
@@ -28,233 +31,20 @@ os.environ["TORCH_DISTRIBUTED_INIT_TIMEOUT"] = "1800"  # 30 minutes
 os.environ["TORCH_NCCL_BLOCKING_WAIT"] = "1"
 os.environ["TORCH_NCCL_ASYNC_ERROR_HANDLING"] = "0"
 
-# ---------------------------------------------------------------
-class CausalSelfAttention(nn.Module):
-
-    def __init__(self, config):
-        super().__init__()
-        assert config.n_embd % config.n_head == 0
-        # key, query, value projections for all heads, but in a batch
-        self.c_attn = nn.Linear(config.n_embd, 3 * config.n_embd)
-        # output projection
-        self.c_proj = nn.Linear(config.n_embd, config.n_embd)
-        self.c_proj.NANOGPT_SCALE_INIT = 1 # normalize residual stream
-        # regularization
-        self.n_head = config.n_head
-        self.n_embd = config.n_embd
-        # this is a mask, not a bias, but following openai naming conventions
-        self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size))
-                                     .view(1, 1, config.block_size, config.block_size))
-
-    def forward(self, x):
-        B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd) - size returns tuple of shapes
-        # calculate query, key, values for all heads in batch and move head forward to be the batch dim
-        # nh is "number of heads", hs is "head size", and C (number of channels) = nh * hs
-        # e.g. in GPT-2 (124M), n_head=12, hs=64, so nh*hs=C=768 channels in the Transformer
-        qkv = self.c_attn(x)
-        q, k, v = qkv.split(self.n_embd, dim=2)
-        # these 3 view operations move the heads to the second dimension so they
-        # are computed in parallel. this is the internal of pt: first 2 dimensions
-        # are auto computed in parallel
-        k = k.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
-        q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
-        v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
-
-        y = F.scaled_dot_product_attention(q, k, v, is_causal=True) # flash attention
-
-        y = y.transpose(1, 2).contiguous().view(B, T, C) # re-assemble all head outputs side by side
-        # output projection
-        y = self.c_proj(y)
-        return y
-
-
-
-class MLP(nn.Module):
-
-    def __init__(self,config):
-        super().__init__()
-        self.c_fc = nn.Linear(config.n_embd, 4 * config.n_embd)
-        # gaussian error linear units
-        # a slightly smoother relu
-        # transformers seem to prefer smooth activations of sharper ones (like relu)
-        self.gelu = nn.GELU(approximate='tanh') # historical quirk to use approximate tanh
-        self.c_proj = nn.Linear(4 * config.n_embd, config.n_embd)
-        self.c_proj.NANOGPT_SCALE_INIT = 1 # normalize residual stream
-
-
-    def forward(self, x):
-        x = self.c_fc(x)
-        x = self.gelu(x)
-        x = self.c_proj(x)
-        return x
-
-class Block(nn.Module):
-
-    def __init__(self,config):
-        super().__init__()
-        self.ln_1 = nn.LayerNorm(config.n_embd)
-        self.attn = CausalSelfAttention(config)
-        self.ln_2 = nn.LayerNorm(config.n_embd)
-        self.mlp = MLP(config)
-
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x))
-        x = x + self.mlp(self.ln_2(x))
-        return x
-
-
-@dataclass
-class GPTConfig:
-    block_size: int = 1024 # max sequence length
-    vocab_size: int = 50257 # number of toks: 50k bpe merges, 256 bytes tokens, 1 <eos> token
-    # 50257 is ugly. odd. we want powers of 2.
-    # 50304 is divisible by 8, 16. better.
-    n_layer: int = 12
-    n_head: int = 12
-    n_embd: int = 768
-    bias: bool = True # True: bias in Linears and LayerNorms, like GPT-2. False: a bit better and faster
-
-class GPT(nn.Module):
-    def __init__(self,config):
-        super().__init__()
-        self.config = config
-
-        self.transformer = nn.ModuleDict(dict(
-            wte = nn.Embedding(config.vocab_size, config.n_embd),
-            wpe = nn.Embedding(config.block_size, config.n_embd),
-            h = nn.ModuleList([Block(config) for _ in range(config.n_layer)]), # h stands for hidden
-            ln_f = nn.LayerNorm(config.n_embd), # final layer norm
-        ))
-        self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False) # final classifier
-
-        # weight sharing
-        self.transformer.wte.weight = self.lm_head.weight
-
-        # init params
-        self.apply(self._init_weights)
-
-    def _init_weights(self, module):
-        if isinstance(module, nn.Linear):
-            std = 0.02
-            if hasattr(module, 'NANOGPT_SCALE_INIT'):
-                std *= (2 * self.config.n_layer) ** -0.5 # 1 over square root of num_layers,
-               # keeps residual stream from ballooning
-               # it's 2x bc attn and ffn both add to the residual pathway
-            torch.nn.init.normal_(module.weight, mean=0.0, std=std)
-            if module.bias is not None:
-                torch.nn.init.zeros_(module.bias)
-        elif isinstance(module, nn.Embedding):
-            torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
-
-    @classmethod
-    def from_pretrained(cls, model_type, override_args=None):
-        assert model_type in {'gpt2', 'gpt2-medium', 'gpt2-large', 'gpt2-xl'}
-        override_args = override_args or {} # default to empty dict
-        # only dropout can be overridden see more notes below
-        assert all(k == 'dropout' for k in override_args)
-        from transformers import GPT2LMHeadModel
-        print("loading weights from pretrained gpt: %s" % model_type)
-
-        # n_layer, n_head and n_embd are determined from model_type
-        config_args = {
-            'gpt2':         dict(n_layer=12, n_head=12, n_embd=768),  # 124M params
-            'gpt2-medium':  dict(n_layer=24, n_head=16, n_embd=1024), # 350M params
-            'gpt2-large':   dict(n_layer=36, n_head=20, n_embd=1280), # 774M params
-            'gpt2-xl':      dict(n_layer=48, n_head=25, n_embd=1600), # 1558M params
-        }[model_type]
-        print("forcing vocab_size=50257, block_size=1024, bias=True")
-        config_args['vocab_size'] = 50257 # always 50257 for GPT model checkpoints
-        config_args['block_size'] = 1024 # always 1024 for GPT model checkpoints
-        config_args['bias'] = True # always True for GPT model checkpoints
-        # we can override the dropout rate, if desired
-        if 'dropout' in override_args:
-            print(f"overriding dropout rate to {override_args['dropout']}")
-            config_args['dropout'] = override_args['dropout']
-        # create a from-scratch initialized minGPT model
-        config = GPTConfig(**config_args)
-        model = GPT(config)
-        sd = model.state_dict()
-        sd_keys = sd.keys()
-        sd_keys = [k for k in sd_keys if not k.endswith('.attn.bias')] # discard this mask / buffer, not a param
-
-        # init a huggingface/transformers model
-        model_hf = GPT2LMHeadModel.from_pretrained(model_type)
-        sd_hf = model_hf.state_dict()
-
-        # copy while ensuring all of the parameters are aligned and match in names and shapes
-        sd_keys_hf = sd_hf.keys()
-        sd_keys_hf = [k for k in sd_keys_hf if not k.endswith('.attn.masked_bias')] # ignore these, just a buffer
-        sd_keys_hf = [k for k in sd_keys_hf if not k.endswith('.attn.bias')] # same, just the mask (buffer)
-        transposed = ['attn.c_attn.weight', 'attn.c_proj.weight', 'mlp.c_fc.weight', 'mlp.c_proj.weight']
-        # basically the openai checkpoints use a "Conv1D" module, but we only want to use a vanilla Linear
-        # this means that we have to transpose these weights when we import them
-        assert len(sd_keys_hf) == len(sd_keys), f"mismatched keys: {len(sd_keys_hf)} != {len(sd_keys)}"
-        for k in sd_keys_hf:
-            if any(k.endswith(w) for w in transposed):
-                # special treatment for the Conv1D weights we need to transpose
-                assert sd_hf[k].shape[::-1] == sd[k].shape
-                with torch.no_grad():
-                    sd[k].copy_(sd_hf[k].t())
-            else:
-                # vanilla copy over the other parameters
-                assert sd_hf[k].shape == sd[k].shape
-                with torch.no_grad():
-                    sd[k].copy_(sd_hf[k])
-
-        return model
-
-    def forward(self, idx, targets=None):
-        B, T = idx.size()
-        assert T <= self.config.block_size, f"Cannot fwd seq of length {T}, block size {self.config.block_size}"
-
-        pos = torch.arange(0, T, dtype=torch.long, device=idx.device) # shape (T)
-        pos_emb = self.transformer.wpe(pos) # pos embs of shape (T, n_embd)
-        tok_emb = self.transformer.wte(idx) # token embs of shape (B, T, n_embd)
-        x = tok_emb + pos_emb
-
-        for block in self.transformer.h:
-            x = block(x)
-
-        x = self.transformer.ln_f(x)
-        logits = self.lm_head(x) # (B,T, vocab_size)
-        loss = None
-        if targets is not None:
-
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1))
-        return logits, loss
-
-    def configure_optimizers(self, weight_decay, learning_rate, device_type): # 2:31:50
-        # this weight decay forces info to go across many smaller channels instead of one big one
-        # start with all of the candidate parameters (that require grad)
-        param_dict = {pn: p for pn, p in self.named_parameters()}
-        param_dict = {pn: p for pn, p in param_dict.items() if p.requires_grad}
-        # create optim groups. Any parameters that is 2D will be weight decayed, otherwise no.
-        # i.e. all weight tensors in matmuls + embeddings decay, all biases and layernorms don't.
-        decay_params = [p for n, p in param_dict.items() if p.dim() >= 2] # decay weights and sometimes embs
-        nodecay_params = [p for n, p in param_dict.items() if p.dim() < 2] # no decay biases and layernorms
-        optim_groups = [
-            {'params': decay_params, 'weight_decay': weight_decay},
-            {'params': nodecay_params, 'weight_decay': 0.0}
-        ]
-        num_decay_params = sum(p.numel() for p in decay_params)
-        num_nodecay_params = sum(p.numel() for p in nodecay_params)
-        if master_process: # this is so if u have gpu clusters it doesn't print 8 times
-            print(f"num decayed parameter tensors: {len(decay_params)}, with {num_decay_params:,} parameters")
-            print(f"num non-decayed parameter tensors: {len(nodecay_params)}, with {num_nodecay_params:,} parameters")
-        # Create AdamW optimizer and use the fused version if it is available
-        fused_available = 'fused' in inspect.signature(torch.optim.AdamW).parameters
-        use_fused = fused_available and device_type == "cuda"
-        if master_process:
-            print(f"using fused AdamW: {use_fused}") # fused is a newer performance optimization
-        optimizer = torch.optim.AdamW(optim_groups, lr=learning_rate, betas=(0.9, 0.95), eps=1e-8, fused=use_fused)
-        return optimizer
-
 # --- setting up DDP (distributed data parallels)
 # torchrun command sets the env variables RANK, LOCAL_RANK and WORLD_SIZE
-
-ddp = int(os.environ.get('RANK', -1))
-if ddp != -1:
-    assert torch.cuda.is_available()
+# nccl on gpus. without gpus every rank trains on cpu and they talk over gloo, e.g.
+# torchrun --nproc_per_node=2 model.py           # one rank per socket
+# torchrun --nnodes=4 --nproc_per_node=2 --rdzv_endpoint=host:29500 model.py
+ddp_backend = os.environ.get("DDP_BACKEND", "nccl" if torch.cuda.is_available() else "gloo")
+# cpu ranks: torch threads per rank (0 = this node's cores split evenly over its ranks),
+# and whether to pin each rank to its own contiguous block of cores, so ranks don't
+# fight over cores and each one's memory stays local to its socket
+cpu_threads = int(os.environ.get("CPU_THREADS", 0))
+pin_cores = True
+
+ddp = int(os.environ.get('RANK', -1)) != -1 # is this a ddp run?
+if ddp:
     # Retry DDP initialization with exponential backoff
     max_retries = 5
     for attempt in range(max_retries):
@@ -263,7 +53,7 @@ if ddp != -1:
                 if int(os.environ['RANK']) == 0:
                     print(f"DDP init attempt {attempt + 1}/{max_retries}")
                 time.sleep(2 ** attempt)  # exponential backoff: 2, 4, 8, 16 seconds
-            init_process_group(backend='nccl', timeout=timedelta(seconds=1800))
+            init_process_group(backend=ddp_backend, timeout=timedelta(seconds=1800))
             break
         except Exception as e:
             if attempt == max_retries - 1:
@@ -277,8 +67,19 @@ if ddp != -1:
     ddp_rank = int(os.environ['RANK'])
     ddp_local_rank = int(os.environ['LOCAL_RANK'])
     ddp_world_size = int(os.environ['WORLD_SIZE'])
-    device = f"cuda:{ddp_local_rank}"
-    torch.cuda.set_device(device)
+    if ddp_backend == 'nccl':
+        device = f"cuda:{ddp_local_rank}"
+        torch.cuda.set_device(device)
+    else:
+        device = "cpu"
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+        per_rank = max(1, len(cores) // local_world_size)
+        if pin_cores and hasattr(os, "sched_setaffinity") and len(cores) >= local_world_size:
+            cores = cores[ddp_local_rank * per_rank:(ddp_local_rank + 1) * per_rank]
+            os.sched_setaffinity(0, cores)
+        torch.set_num_threads(cpu_threads or per_rank) # torchrun defaults OMP_NUM_THREADS to 1
+        print(f"rank {ddp_rank}: cpu, {torch.get_num_threads()} threads on cores {cores[0]}-{cores[-1]}")
     master_process = ddp_rank == 0
 else:
     ddp_rank = 0
@@ -290,36 +91,14 @@ else:
         device = "cuda"
     elif hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
         device = "mps"
+    if device == "cpu" and cpu_threads > 0:
+        torch.set_num_threads(cpu_threads)
     print(f"using device: {device}")
 torch.set_float32_matmul_precision('high')
 torch.manual_seed(1337)
 if torch.cuda.is_available():
     torch.manual_seed(1337)
 
-# -----------------------------------------------------------------------------
-# helper function for HellaSwag eval
-# takes tokens, mask, and logits, returns the index of the completion with the lowest loss
-
-def get_most_likely_row(tokens, mask, logits):
-    # evaluate the autoregressive loss at all positions
-    shift_logits = (logits[..., :-1, :]).contiguous()
-    shift_tokens = (tokens[..., 1:]).contiguous()
-    flat_shift_logits = shift_logits.view(-1, shift_logits.size(-1))
-    flat_shift_tokens = shift_tokens.view(-1)
-    shift_losses = F.cross_entropy(flat_shift_logits, flat_shift_tokens, reduction='none')
-    shift_losses = shift_losses.view(tokens.size(0), -1)
-    # now get the average loss just for the completion region (where mask == 1), in each row
-    shift_mask = (mask[..., 1:]).contiguous() # we must shift mask, so we start at the last prompt token
-    masked_shift_losses = shift_losses * shift_mask
-    # sum and divide by the number of 1s in the mask
-    sum_loss = masked_shift_losses.sum(dim=1)
-    avg_loss = sum_loss / shift_mask.sum(dim=1)
-    # now we have a loss for each of the 4 completions
-    # the one with the lowest loss should be the most likely
-    pred_norm = avg_loss.argmin().item()
-    return pred_norm
-
-
 torch.manual_seed(1337)
 if torch.cuda.is_available():
     torch.cuda.manual_seed(1337)
@@ -327,7 +106,7 @@ if torch.cuda.is_available():
 # --- gradient accumulation 2:36:00 ---
 total_batch_size = 524288 # ~0.5M tokens per gpt-3 small in its paper
 
-B = 64
+B = 64 # micro batch: the chunked loss (GPT.loss_chunk_size) never holds full logits, so this can go up
 T = 1024
 assert total_batch_size % (B * T * ddp_world_size) == 0 # make sure total batch size is divisible by B*T * world_size (number of total gpus)
 grad_accum_steps = total_batch_size // (B * T * ddp_world_size)
@@ -337,74 +116,37 @@ if master_process:
 
 
 
+# torch.compile: the training step is compiled as is, the evals run through separately
+# compiled graphs for a few padded bucket shapes (compiled.py)
+use_compile = True
+
 # -------------------------------
 # dataloader
 
-# -----------------------------------------------------------------------------
-import numpy as np
-import tiktoken
-
-def load_tokens(filename):
-    try:
-        npt = np.load(filename)
-        # npt = npt.astype(np.int32)  # Convert uint16 to int32 for torch compatibility
-        ptt = torch.tensor(npt, dtype=torch.long)
-        return ptt
-    except Exception as e:
-        print(f"Error loading {filename}: {e}")
-        # Try to peek at the file content
-        with open(filename, 'rb') as f:
-            header = f.read(16)
-            print(f"File header (first 16 bytes): {header}")
-        raise e
-
-class DataLoaderLite:
-    def __init__(self, B, T, process_rank, num_processes, split):
-        self.B = B
-        self.T = T
-        self.process_rank = process_rank
-        self.num_processes = num_processes
-        assert split in {'train', 'val'}
-
-        # get the shard filenames
-        data_root = "../data/edu_fineweb10B"
-        shards = os.listdir(data_root)
-        shards = [s for s in shards if split in s]
-        shards = sorted(shards)
-        shards = [os.path.join(data_root, s) for s in shards]
-        self.shards = shards
-        assert len(shards) > 0, f"no shards found for split {split}"
-        if master_process:
-            print(f"found {len(shards)} shards for split {split}")
-
-        # state, init at shard zero
-        self.current_shard = 0
-        self.tokens = load_tokens(self.shards[self.current_shard])
-        self.current_position = self.B * self.T * self.process_rank
-        self.reset()
-
-    def reset(self):
-        self.current_shard = 0
-        self.tokens = load_tokens(self.shards[self.current_shard])
-        self.current_position = self.B * self.T * self.process_rank
-
-    def next_batch(self):
-            B, T = self.B, self.T
-            buf = self.tokens[self.current_position : self.current_position+B*T+1]
-            x = (buf[:-1]).view(B, T) # inputs
-            y = (buf[1:]).view(B, T) # targets
-            # advance the position in the tensor
-            self.current_position += B * T * self.num_processes
-            # if loading the next batch would be out of bounds, advance to next shard
-            if self.current_position + (B * T * self.num_processes + 1) > len(self.tokens):
-                self.current_shard = (self.current_shard + 1) % len(self.shards)
-                self.tokens = load_tokens(self.shards[self.current_shard])
-                self.current_position = B * T * self.process_rank
-            return x, y
-
-
-train_loader = DataLoaderLite(B=B, T=T, process_rank=ddp_rank, num_processes=ddp_world_size, split="train")
-val_loader = DataLoaderLite(B=B, T=T, process_rank=ddp_rank, num_processes=ddp_world_size, split="val")
+# samples are windows of T tokens in a seeded shuffled order per epoch, addressed by a
+# global index. the data position is a pure function of the step: samples_per_step * step
+train_loader = RandomAccessLoader(B=B, T=T, process_rank=ddp_rank, num_processes=ddp_world_size, split="train",
+                                  shuffle=True, seed=1337)
+samples_per_step = total_batch_size // T
+# keep a few batches ready on a background thread (0 = load them synchronously in the step)
+prefetch_depth = 4
+if prefetch_depth > 0:
+    train_loader = PrefetchLoader(train_loader, depth=prefetch_depth, pin_memory='cuda' in device)
+# out of band evals: instead of every rank stopping for val loss, hellaswag and samples,
+# the master only writes a weight snapshot to log/ at the eval steps (in the background),
+# and a separate worker scores it and appends to metrics.bin while training goes on:
+# python eval_checkpoint.py --watch --hellaswag --samples --until 19072   (spare cores / another box)
+async_eval = False
+# the val set is small and fixed: read it once and keep this rank's share resident on device.
+# it's the same tokens the 20 val batches of B*T per rank used to cover
+val_loss_steps = 20
+val_B = 2 * B # no activations kept for backward, so eval can use a bigger batch
+if not async_eval:
+    val_set = ValSet(num_tokens=val_loss_steps * B * T * ddp_world_size, T=T,
+                     process_rank=ddp_rank, num_processes=ddp_world_size, device=device)
+    # compiled: full padded rows in bucket-length batches instead of the kv cached contexts
+    hella_eval = HellaSwagEval("val", process_rank=ddp_rank, num_processes=ddp_world_size, shared_context=not use_compile,
+                               len_buckets=pow2_buckets(64, T) if use_compile else None)
 
 
 # -------------------------------
@@ -415,25 +157,73 @@ val_loader = DataLoaderLite(B=B, T=T, process_rank=ddp_rank, num_processes=ddp_w
 num_return_sequences = 5
 max_length = 30
 
+# checkpoint loading logic
+log_dir = "log" # checkpoints and logs
+initial_iter = 0
+if os.path.exists(log_dir):
+    checkpoint_path = latest_checkpoint(log_dir) # only ever a fully written one
+    if checkpoint_path is not None:
+        checkpoint = load_checkpoint(checkpoint_path) # tensors stay memory-mapped on cpu for now
+        # the checkpoint of step s is taken before step s trains (weights after s updates),
+        # so step s is the one to run next, on samples from s * samples_per_step onwards
+        initial_iter = checkpoint['step']
+        if master_process:
+            print(f"resuming from step {initial_iter}")
+
 # model = GPT.from_pretrained('gpt2')
 # overriding the ugly vocab size number with a power of 2 number here
 # when doing distributed training, WORLD_SIZE models get created now
 # they all have the same seed so they're all identical (2:59)
-model = GPT(GPTConfig(vocab_size=50304))
+if initial_iter > 0:
+    # resuming: build the model around the checkpoint's weights, no random init to throw away
+    model = GPT.from_state_dict(checkpoint['config'], checkpoint.pop('model'))
+else:
+    model = GPT(GPTConfig(vocab_size=50304))
 model.to(device)
-use_compile = False # torch.compile interferes with HellaSwag eval and Generation. TODO fix
+# activation checkpointing: recompute activations in backward instead of keeping them,
+# trading a bit of compute for memory (bigger models / B). "none", "block" (every
+# checkpoint_every-th block), "mlp", or "auto": the cheapest that fits memory_budget
+activation_checkpointing = "none"
+checkpoint_every = 1
+memory_budget = 0.9 * torch.cuda.get_device_properties(device).total_memory if 'cuda' in device else 32e9
+# ZeRO-1: shard the AdamW state over the ranks instead of a full copy on each (ddp only)
+use_zero = False
+use_zero = use_zero and ddp
+if activation_checkpointing == "auto":
+    plan = model.plan_activation_checkpointing(B, T, memory_budget, optimizer_shards=ddp_world_size if use_zero else 1)
+    model.set_activation_checkpointing(plan['mode'], plan['every'])
+    if master_process:
+        print(f"activation checkpointing: {plan['mode']} every {plan['every']}, ~{plan['bytes'] / 1e9:.1f}GB "
+              f"of {memory_budget / 1e9:.1f}GB{'' if plan['fits'] else ' (does not fit!)'}, +{plan['overhead']:.1%} compute")
+else:
+    model.set_activation_checkpointing(activation_checkpointing, checkpoint_every)
+raw_model = model # this contains the configure optimizers func we wanna call (and the weights to save)
+eval_model = BucketedGPT(raw_model) if use_compile else raw_model # val loss, hellaswag, sampling
 if use_compile:
     model = torch.compile(model)
 if ddp:
-    model = DDP(model, device_ids=[ddp_local_rank])
-raw_model = model.module if ddp else model # this contains the configure optimizers func we wanna call
+    model = DDP(model, device_ids=[ddp_local_rank] if 'cuda' in device else None)
 # -- logging --
 # create the log directory we will write checkpoints to and log to
-log_dir = "log"
 os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, f"log.txt")
-with open(log_file, "w") as f: # open for writing to clear the file
-    pass
+# train / val / hella (and the profiler's per-step numbers) go to log/metrics.bin, buffered
+# and appended in blocks. a fresh run starts it over, a resumed one appends (steps it redoes
+# read back as their latest value). python metrics.py exports it for the site's plots
+metrics_file = os.path.join(log_dir, "metrics.bin")
+metrics = MetricsWriter(metrics_file, flush_every=1000, truncate=initial_iter == 0) if master_process else None
+# checkpoints get written in the background, only the last few are kept
+checkpoint_writer = CheckpointWriter(log_dir, keep=3)
+# per-step time, tok/sec and mfu, rolling averages printed every profile_every steps,
+# per-step numbers go to the metrics file. profile_phases = True also times every phase of
+# the step, but syncs the device after each one: that costs the async h2d copy and the cpu
+# queuing backward while forward runs, so it's off for real runs, on to find a bottleneck.
+# trace_steps = (first, last) dumps a torch profiler trace of those steps to log/
+profile_phases = False
+profile_every = 100
+trace_steps = None
+profiler = StepProfiler(device, flops_per_token=flops_per_token(raw_model.config, sum(p.numel() for p in raw_model.parameters()), T),
+                        phases=profile_phases, trace_steps=trace_steps, trace_dir=log_dir,
+                        metrics=metrics)
 
 # --- cosine decay lr ----
 max_lr = 6e-4 # gpt-3 small LR per their paper (gpt-2 doesn't specify)
@@ -457,25 +247,17 @@ def get_lr(it):
 
 device_type = 'cuda' if 'cuda' in device else 'cpu'
 
-# checkpoint loading logic
-initial_iter = 0
-if os.path.exists(log_dir):
-    checkpoints = [f for f in os.listdir(log_dir) if f.startswith('model_')]
-    if checkpoints:
-        latest = max(checkpoints, key=lambda x: int(x.split('_')[1].split('.')[0]))
-        checkpoint_path = os.path.join(log_dir, latest)
-        checkpoint = torch.load(checkpoint_path, map_location=device)
-        raw_model.load_state_dict(checkpoint['model'])
-        initial_iter = checkpoint['step'] + 1
-        if master_process:
-            print(f"resuming from step {initial_iter}")
-
-optimizer = raw_model.configure_optimizers(weight_decay=0.1, learning_rate=6e-4, device_type=device_type)
+optimizer = raw_model.configure_optimizers(weight_decay=0.1, learning_rate=6e-4, device_type=device_type, zero=use_zero)
 
 # load optimizer state if checkpoint exists
 if initial_iter > 0:
+    # the data position is a function of the step alone, so it's set even if restoring the
+    # rest below fails. no saved loader state needed: works after changing the world size or B too
+    train_loader.set_state(initial_iter * samples_per_step)
     try:
         if 'optimizer' in checkpoint:
+            # checkpoints hold the whole optimizer state. ZeRO keeps this rank's shard of it,
+            # so a run can resume with or without ZeRO and on a different number of ranks
             optimizer.load_state_dict(checkpoint['optimizer'])
         if 'rng_state' in checkpoint:
             rng_state = checkpoint['rng_state']
@@ -495,11 +277,6 @@ if initial_iter > 0:
                 if isinstance(cuda_rng_state, torch.Tensor):
                     cuda_rng_state = cuda_rng_state.to(torch.uint8)
             torch.cuda.set_rng_state(cuda_rng_state)
-        if 'loader_position' in checkpoint:
-            train_loader.current_position = checkpoint['loader_position']
-        if 'loader_shard' in checkpoint:
-            train_loader.current_shard = checkpoint['loader_shard']
-            train_loader.tokens = load_tokens(train_loader.shards[train_loader.current_shard])
         # reset lr scheduler
         for param_group in optimizer.param_groups:
             param_group['lr'] = get_lr(initial_iter)
@@ -511,27 +288,20 @@ if initial_iter > 0:
             print("Continuing with partial checkpoint restore...")
 
 for step in range(initial_iter, max_steps):
-    t0 = time.time()
+    profiler.start_step(step)
     last_step = (step == max_steps - 1)
+    eval_step = step % 500 == 0 or last_step
     # occasionally find out the val loss
-    if step % 500 == 0 or last_step:
+    if eval_step and not async_eval:
         model.eval()
-        val_loader.reset()
         if torch.cuda.is_available():
             torch.cuda.reset_peak_memory_stats()
             torch.cuda.empty_cache()
-        with torch.no_grad():
-            val_loss_accum = 0.0
-            val_loss_steps = 20
-            for _ in range(val_loss_steps):
-                x, y = val_loader.next_batch()
-                x, y = x.to(device), y.to(device)
-                with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
-                    logits, loss = model(x,y)
-                loss = loss / val_loss_steps
-                val_loss_accum += loss.detach()
+        val_loss_sum, val_count = evaluate_val_loss(eval_model, val_set, val_B, device_type)
         if ddp:
-            dist.all_reduce(val_loss_accum, op=dist.ReduceOp.AVG)
+            dist.all_reduce(val_loss_sum, op=dist.ReduceOp.SUM)
+            dist.all_reduce(val_count, op=dist.ReduceOp.SUM)
+        val_loss_accum = val_loss_sum / val_count
         if master_process:
             val_loss_val = val_loss_accum.item()
             print(f"step {step}, val loss: {val_loss_val:.4f}")
@@ -540,13 +310,15 @@ for step in range(initial_iter, max_steps):
                 train_val_gap = val_loss_val - prev_train_loss
                 if train_val_gap > 1.5:
                     print(f"Warning: Large train/val gap ({train_val_gap:.3f}) - possible overfitting")
-            with open(log_file, "a") as f:
-                f.write(f"{step} val {val_loss_val:.4f}\n")
+            metrics.log(step, "val", val_loss_val)
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
 
-    if step > 0 and (step % 1000 == 0 or last_step):
-        checkpoint_path = os.path.join(log_dir, f"model_{step:05d}.pt")
+    save_step = step > initial_iter and (step % 1000 == 0 or last_step) # (the resumed step is on disk already)
+    if save_step and use_zero:
+        optimizer.consolidate_state_dict(to=0) # every rank sends its shard, rank 0 saves the whole state
+    if save_step and master_process:
+        metrics.flush() # the metrics on disk go as far as the checkpoint
         # ensure RNG states are ByteTensors for compatibility
         rng_state = torch.get_rng_state()
         cuda_rng_state = torch.cuda.get_rng_state() if torch.cuda.is_available() else None
@@ -555,34 +327,20 @@ for step in range(initial_iter, max_steps):
             'model': raw_model.state_dict(),
             'config': raw_model.config,
             'step': step,
-            'val_loss': val_loss_accum.item(),
+            'val_loss': val_loss_accum.item() if not async_eval else None, # async: in metrics.bin, later
             'optimizer': optimizer.state_dict(),
             'rng_state': rng_state.byte() if not isinstance(rng_state, torch.ByteTensor) else rng_state,
             'cuda_rng_state': cuda_rng_state.byte() if cuda_rng_state is not None and not isinstance(cuda_rng_state, torch.ByteTensor) else cuda_rng_state,
-            'loader_position': train_loader.current_position,
-            'loader_shard': train_loader.current_shard,
+            'loader_sample': step * samples_per_step, # for reference, resuming recomputes it from the step
         }
-        torch.save(checkpoint, checkpoint_path)
+        checkpoint_writer.save(checkpoint, step) # snapshots to host memory, writes in the background
+    elif eval_step and async_eval and master_process:
+        # just the weights for the eval worker (a checkpoint step it scores from the checkpoint)
+        checkpoint_writer.save_snapshot({'model': raw_model.state_dict(), 'config': raw_model.config, 'step': step}, step)
 
     # once in a while evaluate hellaswag
-    if (step % 500 == 0 or last_step) and (not use_compile):
-        num_correct_norm = 0
-        num_total = 0
-        for i, example in enumerate(iterate_examples("val")):
-            # only process examples where i % ddp_world_size == ddp_rank
-            if i % ddp_world_size != ddp_rank:
-                continue
-            # render the example into tokens and labels
-            _, tokens, mask, label = render_example(example)
-            tokens = tokens.to(device)
-            mask = mask.to(device)
-            # get the logits
-            with torch.no_grad():
-                with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
-                    logits, loss = model(tokens)
-                pred_norm = get_most_likely_row(tokens, mask, logits)
-            num_total += 1
-            num_correct_norm += int(pred_norm == label)
+    if eval_step and not async_eval:
+        num_correct_norm, num_total = hella_eval.evaluate(eval_model, device, device_type)
         # reduce the stats across all processes
         if ddp:
             num_total = torch.tensor(num_total, dtype=torch.long, device=device)
@@ -594,92 +352,87 @@ for step in range(initial_iter, max_steps):
         acc_norm = num_correct_norm / num_total
         if master_process:
             print(f"HellaSwag accuracy: {num_correct_norm}/{num_total}={acc_norm:.4f}")
-            with open(log_file, "a") as f:
-                f.write(f"{step} hella {acc_norm:.4f}\n")
+            metrics.log(step, "hella", acc_norm)
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
-    if ((step > 0 and step % 500 == 0) or last_step) and (not use_compile):
+    if ((step > 0 and step % 500 == 0) or last_step) and not async_eval:
         model.eval()
         num_return_sequences = 4
         max_length = 32
         tokens = enc.encode("Hello, I'm a language model,")
-        tokens = torch.tensor(tokens, dtype=torch.long)
-        tokens = tokens.unsqueeze(0).repeat(num_return_sequences, 1)
-        xgen = tokens.to(device)
-        sample_rng = torch.Generator(device=device)
-        sample_rng.manual_seed(42 + ddp_rank)
-        # in training loop
-        while xgen.size(1) < max_length:
-            # forward the model to get the logits
-            with torch.no_grad():
-                with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
-                    logits, loss = model(xgen) # (B, T, vocab_size)
-                # take the logits at the last position
-                logits = logits[:, -1, :] # (B, vocab_size)
-                # get the probabilities
-                probs = F.softmax(logits, dim=-1)
-                # do top-k sampling of 50 (huggingface pipeline default)
-                # topk_probs here becomes (5, 50), topk_indices is (5, 50)
-                topk_probs, topk_indices = torch.topk(probs, 50, dim=-1)
-                # select a token from the top-k probabilities
-                # note: multinomial does not demand the input to sum to 1
-                ix = torch.multinomial(topk_probs, 1, generator=sample_rng) # (B, 1)
-                # gather the corresponding indices
-                xcol = torch.gather(topk_indices, -1, ix) # (B, 1)
-                # append to the sequence
-                xgen = torch.cat((xgen, xcol), dim=1)
+        prompts = [tokens] * num_return_sequences
+        # top-k sampling of 50 (huggingface pipeline default), every sequence with its own rng.
+        # the kv cache inside means every step only forwards the token we just sampled
+        seeds = [42 + ddp_rank * num_return_sequences + i for i in range(num_return_sequences)]
+        completions = [[] for _ in range(num_return_sequences)]
+        for next_tokens in generate_stream(eval_model, prompts, max_length - len(tokens), device, top_k=50, seeds=seeds):
+            for completion, token in zip(completions, next_tokens):
+                completion.append(token)
         # print the generated text
         for i in range(num_return_sequences):
-            tokens = xgen[i, :max_length].tolist()
-            decoded = enc.decode(tokens)
+            decoded = enc.decode(tokens + completions[i])
             print(f"rank {ddp_rank} sample {i}: {decoded}")
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
 
+    profiler.phase("eval") # val loss, checkpoint, hellaswag and samples, on the steps that do them
+
     model.train()
     optimizer.zero_grad()
     loss_accum = 0.0
     # gradient accumulation 2:39:23
     for micro_step in range(grad_accum_steps):
         x, y = train_loader.next_batch()
-        x, y = x.to(device), y.to(device)
+        profiler.phase("next_batch")
+        x, y = x.to(device, non_blocking=True), y.to(device, non_blocking=True)
+        profiler.phase("h2d")
         if ddp:
             model.require_backward_grad_sync = (micro_step == grad_accum_steps - 1) # should only share grads on last step
         with torch.autocast(device_type=device_type, dtype=torch.bfloat16): # bfloat only possible with ampere gpus
             logits, loss = model(x,y)
         loss = loss / grad_accum_steps # 2:44, otherwise losses sum over the accumulated passes
         loss_accum += loss.detach()
+        profiler.phase("forward")
         loss.backward()
+        # ddp all-reduces the gradients during the last backward, overlapped with it,
+        # so that backward is charged separately: its excess over the others is comms
+        profiler.phase("backward_allreduce" if ddp and micro_step == grad_accum_steps - 1 else "backward")
     if ddp:
-        dist.all_reduce(loss_accum, op=dist.ReduceOp.AVG) # average the loss across all gpus
+        dist.all_reduce(loss_accum, op=dist.ReduceOp.SUM) # average the loss across all ranks
+        loss_accum /= ddp_world_size # (gloo has no ReduceOp.AVG)
+        profiler.phase("allreduce")
     # final gradient clipping after accumulation
     # 2:18:00
     norm = torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
+    profiler.phase("clip")
     # lr scheduler is cosine decay (2:22)
     lr = get_lr(step)
     for param_group in optimizer.param_groups: # pt treats params as groups in optimization;
     #there's only one item in this group fyi
         param_group['lr'] = lr
     optimizer.step()
-    torch.cuda.synchronize() # this awaits for all kernels to finish
-    t1 = time.time()
-    dt = (t1 - t0)*1000
+    profiler.phase("optimizer")
     tokens_processed = train_loader.B * train_loader.T * grad_accum_steps * ddp_world_size
-    tokens_per_sec = tokens_processed / (t1 - t0)
+    step_metrics = profiler.end_step(tokens_processed) # syncs the device, whichever it is
+    dt = step_metrics["dt"] * 1000
+    tokens_per_sec = step_metrics["tokens_per_sec"]
     # keep an eye on gradient norms, signal of problems if anomalies
     if master_process:
         train_loss = loss_accum.item()
         print(f"step {step}, loss: {train_loss:.6f}, lr: {lr:.4e}, norm: {norm:.4f}, dt: {dt:.2f}ms, tok/sec: {tokens_per_sec:.2f}")
         # Store for overfitting detection
         prev_train_loss = train_loss
-        with open(log_file, "a") as f:
-            f.write(f"{step} train {train_loss:.6f}\n")
+        metrics.log(step, "train", train_loss)
+        if (step + 1) % profile_every == 0 or last_step:
+            print(profiler.summary())
 
 if ddp:
     destroy_process_group()
 
 # only master saves & uploads
 if master_process:
+    metrics.close() # flushes what's still buffered
+    checkpoint_writer.wait() # make sure the last checkpoint made it to disk
     # create repo (once)
 
     # save the raw model (not ddp wrapper)
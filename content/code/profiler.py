@@ -0,0 +1,144 @@
+import os
+import time
+import resource
+from collections import defaultdict, deque
+import torch
+
+# -----------------------------------------------------------------------------
+# per-phase step timing for the training loop. each phase (next_batch, h2d copy,
+# forward, backward, all-reduce, clip, optimizer step) is bracketed by a device sync,
+# so gpu work gets charged to the phase that launched it instead of to whatever
+# happens to wait on it later. the syncs cost a bit of cpu/gpu overlap, which is why
+# it can be switched off: then only the end of the step syncs, like before
+
+# dense bf16 peak flops of the gpus we train on, for mfu. unknown devices get no mfu
+peak_flops_by_device = {
+    "H100": 989e12,
+    "A100": 312e12,
+    "A10": 125e12,
+    "L4": 121e12,
+    "4090": 165e12,
+}
+
+def sync(device):
+    # wait for all queued kernels, whatever the device
+    if 'cuda' in device:
+        torch.cuda.synchronize()
+    elif 'mps' in device:
+        torch.mps.synchronize()
+
+def peak_flops(device):
+    if 'cuda' not in device:
+        return None
+    name = torch.cuda.get_device_name(device)
+    for k, v in peak_flops_by_device.items():
+        if k in name:
+            return v
+    return None
+
+def flops_per_token(config, num_params, T):
+    # forward + backward flops per token, as in the PaLM paper appendix B: 6 flops per
+    # parameter (2 forward, 4 backward) plus the attention matmuls over the context
+    L, H, Q = config.n_layer, config.n_head, config.n_embd // config.n_head
+    return 6 * num_params + 12 * L * H * Q * T
+
+def peak_memory(device):
+    # peak memory since the last reset in bytes: allocator peak on cuda, process rss on cpu
+    if 'cuda' in device:
+        return torch.cuda.max_memory_allocated(device)
+    if 'mps' in device:
+        return torch.mps.driver_allocated_memory()
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # kilobytes on linux
+
+class StepProfiler:
+
+    def __init__(self, device, flops_per_token=None, phases=True, window=50,
+                 trace_steps=None, trace_dir="log", metrics=None):
+        self.device = device
+        self.flops_per_token = flops_per_token
+        self.peak_flops = peak_flops(device)
+        self.phases = phases # False: no syncs between phases, only the step total
+        self.window = window # rolling aggregates over this many steps
+        self.trace_steps = trace_steps # (first, last) step to capture a torch profiler trace of
+        self.trace_dir = trace_dir
+        self.metrics = metrics # a metrics.MetricsWriter to record every step to, if given
+        self.history = deque(maxlen=window)
+        self.trace = None
+
+    def start_step(self, step):
+        self.step = step
+        self.times = defaultdict(float)
+        if self.trace_steps is not None and step == self.trace_steps[0]:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if 'cuda' in self.device:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True, with_stack=True)
+            self.trace.start()
+        if 'cuda' in self.device:
+            torch.cuda.reset_peak_memory_stats(self.device)
+        sync(self.device)
+        self.t0 = time.time()
+        self.t_phase = self.t0
+
+    def phase(self, name):
+        # call right after the work of phase `name` was issued: charges the time since the
+        # previous phase ended to it. accumulates, so it can be called once per micro step
+        if not self.phases:
+            return
+        sync(self.device)
+        t = time.time()
+        self.times[name] += t - self.t_phase
+        self.t_phase = t
+
+    def end_step(self, tokens):
+        # returns this step's metrics: dt and tok/sec, phase breakdown, mfu, peak memory
+        sync(self.device) # this awaits for all kernels to finish
+        t1 = time.time()
+        dt = t1 - self.t0
+        if self.phases and t1 > self.t_phase:
+            self.times["other"] += t1 - self.t_phase
+        metrics = {
+            "step": self.step,
+            "dt": dt,
+            "tokens_per_sec": tokens / dt,
+            "phases": dict(self.times),
+            "peak_memory": peak_memory(self.device),
+        }
+        if self.flops_per_token is not None and self.peak_flops is not None:
+            metrics["mfu"] = self.flops_per_token * tokens / dt / self.peak_flops
+        self.history.append(metrics)
+        if self.trace is not None and self.step == self.trace_steps[1]:
+            self.trace.stop()
+            os.makedirs(self.trace_dir, exist_ok=True)
+            path = os.path.join(self.trace_dir, f"trace_{self.trace_steps[0]}-{self.trace_steps[1]}.json")
+            self.trace.export_chrome_trace(path) # open in chrome://tracing or perfetto
+            print(f"wrote profiler trace to {path}")
+            self.trace = None
+        if self.metrics is not None:
+            for k in ("dt", "tokens_per_sec", "mfu", "peak_memory"):
+                if k in metrics:
+                    self.metrics.log(self.step, k, metrics[k])
+            for k, v in metrics["phases"].items():
+                self.metrics.log(self.step, f"phase/{k}", v)
+        return metrics
+
+    def summary(self):
+        # rolling aggregates over the last `window` steps: mean time per phase and its share
+        # of the step. a fat next_batch means the loader stalls, a fat all-reduce means comms
+        n = len(self.history)
+        if n == 0:
+            return ""
+        dt = sum(m["dt"] for m in self.history) / n
+        totals = defaultdict(float)
+        for m in self.history:
+            for k, v in m["phases"].items():
+                totals[k] += v / n
+        parts = [f"{k} {v * 1000:.1f}ms ({v / dt:.0%})" for k, v in totals.items()]
+        line = f"last {n} steps: dt {dt * 1000:.1f}ms"
+        if parts:
+            line += " | " + ", ".join(parts)
+        mfus = [m["mfu"] for m in self.history if "mfu" in m]
+        if mfus:
+            line += f" | mfu {sum(mfus) / len(mfus):.1%}"
+        line += f" | peak mem {max(m['peak_memory'] for m in self.history) / 1e9:.2f}GB"
+        return line
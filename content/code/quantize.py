@@ -0,0 +1,130 @@
+# int8 weight-only quantization for cpu inference. decoding a token at a time is memory
+# bandwidth bound: every step streams all the weights through the cpu, so storing them as
+# int8 (one fp32 scale per output channel) moves ~4x fewer bytes per token.
+# c_attn, c_proj, c_fc and lm_head become Int8Linear, and since wte is tied to lm_head it
+# becomes an Int8Embedding reading the very same int8 tensor, so the tying survives.
+# python quantize.py --checkpoint log/model_19072 --hellaswag   # fp32 vs int8 val loss / hellaswag / speed
+import argparse
+import time
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+
+from gpt import GPT, GPTConfig, KVCache # GPTConfig has to be importable to unpickle checkpoint['config']
+
+# fused int8 weight x float activation matmul (cpu kernel), newer pytorch only
+has_int8pack_mm = hasattr(torch.ops.aten, '_weight_int8pack_mm')
+
+def quantize_weight(w):
+    # symmetric per output channel (= per row): w ~= q * scales[:, None]
+    scales = w.abs().amax(dim=1).clamp(min=1e-8) / 127.0
+    q = torch.round(w / scales[:, None]).clamp(-128, 127).to(torch.int8)
+    return q, scales.float()
+
+class Int8Linear(nn.Module):
+
+    def __init__(self, weight, scales, bias=None):
+        super().__init__()
+        self.register_buffer("weight", weight) # (out_features, in_features) int8
+        self.register_buffer("scales", scales) # (out_features,) float
+        self.register_buffer("bias", bias)
+
+    @classmethod
+    def from_linear(cls, linear):
+        q, scales = quantize_weight(linear.weight.detach())
+        bias = linear.bias.detach().clone() if linear.bias is not None else None
+        return cls(q, scales, bias)
+
+    def forward(self, x):
+        shape = x.shape
+        x = x.reshape(-1, shape[-1])
+        scales = self.scales.to(x.dtype)
+        if has_int8pack_mm and x.device.type == 'cpu':
+            y = torch.ops.aten._weight_int8pack_mm(x.contiguous(), self.weight, scales)
+        else:
+            y = F.linear(x, self.weight.to(x.dtype)) * scales
+        y = y.view(*shape[:-1], -1)
+        if self.bias is not None:
+            y = y + self.bias.to(y.dtype)
+        return y
+
+class Int8Embedding(nn.Module):
+
+    def __init__(self, weight, scales):
+        super().__init__()
+        self.register_buffer("weight", weight) # (num_embeddings, embedding_dim) int8
+        self.register_buffer("scales", scales) # (num_embeddings,) float
+
+    def forward(self, idx):
+        return self.weight[idx].float() * self.scales[idx].unsqueeze(-1)
+
+@torch.no_grad()
+def quantize_model(model):
+    # in place, returns the model for convenience
+    for block in model.transformer.h:
+        block.attn.c_attn = Int8Linear.from_linear(block.attn.c_attn)
+        block.attn.c_proj = Int8Linear.from_linear(block.attn.c_proj)
+        block.mlp.c_fc = Int8Linear.from_linear(block.mlp.c_fc)
+        block.mlp.c_proj = Int8Linear.from_linear(block.mlp.c_proj)
+    # weight sharing: one int8 tensor (+ scales) for both ends of the model
+    lm_head = Int8Linear.from_linear(model.lm_head)
+    model.lm_head = lm_head
+    model.transformer.wte = Int8Embedding(lm_head.weight, lm_head.scales)
+    return model
+
+def model_bytes(model):
+    # parameters + buffers, counting shared tensors (the tied wte / lm_head) once
+    seen = {}
+    for t in list(model.parameters()) + list(model.buffers()):
+        seen[t.data_ptr()] = t.numel() * t.element_size()
+    return sum(seen.values())
+
+@torch.no_grad()
+def decode_tokens_per_sec(model, n_tokens=100, device="cpu"):
+    # single sequence kv-cached decode, the interactive case
+    kv_cache = KVCache(model.config, 1)
+    idx = torch.zeros((1, 1), dtype=torch.long, device=device)
+    model(idx, kv_cache=kv_cache, last_only=True) # warmup
+    t0 = time.time()
+    for _ in range(n_tokens):
+        logits, _ = model(idx, kv_cache=kv_cache, last_only=True)
+        idx = logits[:, -1, :].argmax(dim=-1, keepdim=True)
+    return n_tokens / (time.time() - t0)
+
+if __name__ == "__main__":
+    from dataloader import ValSet
+    from evals import HellaSwagEval, evaluate_val_loss
+    from checkpoint import load_checkpoint
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", type=str, required=True)
+    parser.add_argument("--val_tokens", type=int, default=20 * 64 * 1024)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--hellaswag", action="store_true")
+    args = parser.parse_args()
+
+    device = "cpu"
+    checkpoint = load_checkpoint(args.checkpoint)
+    model = GPT.from_state_dict(checkpoint['config'], checkpoint['model'])
+    del checkpoint
+    model.eval()
+    val_set = ValSet(num_tokens=args.val_tokens, T=1024, process_rank=0, num_processes=1, device=device)
+    hella_eval = HellaSwagEval("val", process_rank=0, num_processes=1) if args.hellaswag else None
+
+    def report(name, model):
+        # no bf16 autocast: fp32 really is fp32, and int8 is int8 weights with fp32 the rest
+        loss_sum, count = evaluate_val_loss(model, val_set, args.batch_size, device_type=device, autocast=False)
+        results = {"val loss": (loss_sum / count).item()}
+        line = f"{name}: val loss {results['val loss']:.4f}"
+        if hella_eval is not None:
+            num_correct_norm, num_total = hella_eval.evaluate(model, device, device_type=device, autocast=False)
+            results["hellaswag"] = num_correct_norm / num_total
+            line += f", hellaswag {results['hellaswag']:.4f}"
+        line += f", weights {model_bytes(model) / 1e6:.1f}MB, decode {decode_tokens_per_sec(model):.1f} tok/sec"
+        print(line)
+        return results
+
+    fp32 = report("fp32", model)
+    int8 = report("int8", quantize_model(model))
+    # what quantization costs: val loss should barely go up, hellaswag barely down
+    print("int8 - fp32: " + ", ".join(f"{k} {int8[k] - fp32[k]:+.4f}" for k in fp32))
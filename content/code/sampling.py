@@ -0,0 +1,66 @@
+import torch
+from torch.nn import functional as F
+
+from gpt import KVCache
+
+# -----------------------------------------------------------------------------
+# sampling, for the training loop samples, the inference engine and scripts
+
+# the gpt-2 tokenizer has 50257 tokens, the model's vocab is padded to 50304 (a nicer
+# number for the matmuls). the padded slots never show up in the data, so they're never
+# trained towards anything sensible: cut them off instead of hoping their logits are tiny
+num_tokens = 50257
+
+def make_generator(seed, device):
+    generator = torch.Generator(device=device)
+    generator.manual_seed(seed)
+    return generator
+
+def sample(logits, temperature, top_k, top_p, generators):
+    # one token per row, every row with its own settings:
+    # logits (B, vocab_size), temperature / top_p (B,) floats, top_k (B,) ints (0 = no top-k),
+    # a temperature of 0 is greedy. generators: one torch.Generator per row, so what a row
+    # samples only depends on its own seed, not on what else is in the batch
+    logits = logits[:, :num_tokens].float()
+    B, V = logits.shape
+    k = torch.where(top_k > 0, top_k, V).clamp(max=V)
+    k_max = int(k.max())
+    # a single sorted top-k for the whole batch, each row then keeps its own first k
+    vals, indices = torch.topk(logits, k_max, dim=-1) # (B, k_max)
+    vals = vals / temperature.clamp(min=1e-5)[:, None]
+    ranks = torch.arange(k_max, device=logits.device)
+    vals = vals.masked_fill(ranks[None, :] >= k[:, None], float('-inf'))
+    probs = F.softmax(vals, dim=-1)
+    # top-p (nucleus): the shortest prefix holding top_p of the mass (the first token always).
+    # rows with top_p >= 1 skip it: the float cumsum can round up to 1 and cut the tail
+    nucleus = (probs.cumsum(dim=-1) - probs >= top_p[:, None]) & (top_p < 1)[:, None]
+    probs = probs.masked_fill(nucleus, 0.0)
+    # inverse cdf sampling: one uniform per row, drawn from that row's generator
+    cdf = probs.cumsum(dim=-1)
+    u = torch.stack([torch.rand((), generator=g, device=g.device) for g in generators]).to(logits.device)
+    choice = torch.searchsorted(cdf, (u * cdf[:, -1])[:, None]).clamp(max=k_max - 1) # (B, 1)
+    choice = choice.masked_fill((temperature <= 0)[:, None], 0) # greedy: the top token
+    return indices.gather(-1, choice).view(-1)
+
+@torch.no_grad()
+def generate_stream(model, prompts, max_new_tokens, device, temperature=1.0, top_k=50, top_p=1.0, seeds=None):
+    # prompts: a list of B equally long token lists. yields the B new tokens (a list) after
+    # every step, so the first ones are out after a single (prefill) forward.
+    # model: a GPT or anything with its call signature (compiled.BucketedGPT)
+    B, T = len(prompts), len(prompts[0])
+    assert all(len(p) == T for p in prompts), "prompts must have the same length"
+    max_new_tokens = min(max_new_tokens, model.config.block_size - T)
+    device_type = 'cuda' if 'cuda' in str(device) else 'cpu'
+    kv_cache = KVCache(model.config, B, max_len=T + max_new_tokens)
+    seeds = seeds if seeds is not None else range(B)
+    generators = [make_generator(seed, device) for seed in seeds]
+    temperature = torch.full((B,), float(temperature), device=device)
+    top_k = torch.full((B,), int(top_k), dtype=torch.long, device=device)
+    top_p = torch.full((B,), float(top_p), device=device)
+    idx = torch.tensor(prompts, dtype=torch.long, device=device)
+    for _ in range(max_new_tokens):
+        with torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=device_type == 'cuda'):
+            logits, _ = model(idx, kv_cache=kv_cache, last_only=True)
+        next_tokens = sample(logits[:, -1, :], temperature, top_k, top_p, generators)
+        yield next_tokens.tolist()
+        idx = next_tokens[:, None] # only the new token goes through the model next time
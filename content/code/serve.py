@@ -0,0 +1,163 @@
+import queue
+import itertools
+import threading
+import traceback
+import torch
+
+from gpt import KVCache
+from sampling import sample, make_generator
+
+# -----------------------------------------------------------------------------
+# continuous batching inference engine
+# requests go into a queue, a single scheduler thread owns the model and runs one
+# decode step at a time for every sequence in the batch. between two steps, finished
+# sequences give up their row (slot) and waiting requests are prefilled into free slots,
+# so a new user never waits for somebody else's whole completion, and every step
+# forwards as many sequences as there are users instead of one
+
+class Request:
+
+    def __init__(self, tokens, max_length, temperature, top_k, top_p, generator):
+        self.tokens = list(tokens) # prompt, then the generated tokens get appended
+        self.max_length = max_length # total length incl. the prompt, like the hf pipeline
+        self.temperature = temperature # 0 = greedy
+        self.top_k = top_k # 0 = no top-k
+        self.top_p = top_p # 1.0 = no nucleus cut
+        self.generator = generator # this request's own rng: same seed, same completion
+        self.stream = queue.Queue() # every new token as it's sampled, then None when done
+        self.done = threading.Event()
+        self.error = None # the exception that ended it early, if any
+
+    def emit(self, token):
+        self.tokens.append(token)
+        self.stream.put(token)
+
+    def finish(self, error=None):
+        self.error = error
+        self.stream.put(None)
+        self.done.set()
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError("generation failed") from self.error
+
+class InferenceEngine:
+
+    def __init__(self, model, device, max_batch=8, top_k=50, seed=42):
+        # top_k and seed are the defaults for requests that don't bring their own
+        self.model = model
+        self.device = device
+        self.device_type = 'cuda' if 'cuda' in device else 'cpu'
+        self.max_batch = max_batch
+        self.top_k = top_k
+        self.block_size = model.config.block_size
+        self.waiting = queue.Queue()
+        self.slots = [None] * max_batch # the Request decoding in each row, None = free
+        self.kv_cache = KVCache(model.config, max_batch)
+        self.seed = seed
+        self.admitting = None # the request being prefilled, until it has a row
+        self.submitted = itertools.count() # next() is atomic: concurrent submits get distinct seeds
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, tokens, max_length, temperature=1.0, top_k=None, top_p=1.0, seed=None):
+        assert len(tokens) > 0, "need at least one prompt token"
+        tokens = tokens[-(self.block_size - 1):] # leave room for at least one new token
+        if seed is None:
+            seed = self.seed + next(self.submitted) # distinct, but reproducible per engine
+        top_k = self.top_k if top_k is None else top_k
+        generator = make_generator(seed, self.device)
+        request = Request(tokens, min(max_length, self.block_size), temperature, top_k, top_p, generator)
+        self.waiting.put(request)
+        return request
+
+    def generate(self, tokens, max_length, **sampling):
+        # blocking convenience wrapper: returns prompt + completion tokens
+        request = self.submit(tokens, max_length, **sampling)
+        request.done.wait()
+        request.check()
+        return request.tokens
+
+    def stream(self, tokens, max_length, **sampling):
+        # yields the new tokens one by one, as soon as the scheduler samples them
+        request = self.submit(tokens, max_length, **sampling)
+        while (token := request.stream.get()) is not None:
+            yield token
+        request.check()
+
+    def _forward(self, idx, kv_cache):
+        with torch.no_grad():
+            # bf16 pays off on gpus, on cpu we stay in fp32
+            with torch.autocast(device_type=self.device_type, dtype=torch.bfloat16, enabled=self.device_type == 'cuda'):
+                logits, _ = self.model(idx, kv_cache=kv_cache, last_only=True)
+        return logits[:, -1, :] # (B, vocab_size)
+
+    def _sample(self, logits, requests):
+        # one token per request, each with its own temperature / top-k / top-p and rng,
+        # all rows in a single batched sampler call
+        temperature = torch.tensor([r.temperature for r in requests], dtype=torch.float, device=self.device)
+        top_k = torch.tensor([r.top_k for r in requests], dtype=torch.long, device=self.device)
+        top_p = torch.tensor([r.top_p for r in requests], dtype=torch.float, device=self.device)
+        return sample(logits, temperature, top_k, top_p, [r.generator for r in requests]).tolist()
+
+    def _admit(self):
+        # prefill waiting requests into free slots. block if there's nothing to decode
+        for row in range(self.max_batch):
+            if self.slots[row] is not None:
+                continue
+            idle = all(r is None for r in self.slots)
+            try:
+                request = self.waiting.get(block=idle)
+            except queue.Empty:
+                return
+            self.admitting = request
+            prompt = torch.tensor([request.tokens], dtype=torch.long, device=self.device)
+            prefill = KVCache(self.model.config, 1, max_len=len(request.tokens))
+            logits = self._forward(prompt, prefill)
+            request.emit(self._sample(logits, [request])[0])
+            if len(request.tokens) >= request.max_length:
+                self.admitting = None
+                request.finish()
+                continue
+            self.kv_cache.copy_row(row, prefill)
+            self.slots[row] = request
+            self.admitting = None
+
+    def _step(self):
+        # one decode step for every occupied row: feed each row its last token
+        rows = [row for row, r in enumerate(self.slots) if r is not None]
+        if not rows:
+            return
+        # cached length of each row = all its tokens but the last one, free rows just idle at 0
+        lengths = [len(r.tokens) - 1 if r is not None else 0 for r in self.slots]
+        last = [r.tokens[-1] if r is not None else 0 for r in self.slots]
+        self.kv_cache.set_lengths(lengths, self.device)
+        idx = torch.tensor(last, dtype=torch.long, device=self.device)[:, None] # (max_batch, 1)
+        logits = self._forward(idx, self.kv_cache)[rows] # free rows don't get sampled
+        next_tokens = self._sample(logits, [self.slots[row] for row in rows])
+        for row, token in zip(rows, next_tokens):
+            request = self.slots[row]
+            request.emit(token)
+            if len(request.tokens) >= request.max_length:
+                self.slots[row] = None # retire, the row is free for the next request
+                request.finish()
+
+    def _fail(self, error):
+        # end every request the failed iteration touched, so nobody waits on them forever,
+        # and free their rows. the engine itself keeps serving the requests after them
+        failed = [r for r in self.slots if r is not None]
+        if self.admitting is not None:
+            failed.append(self.admitting)
+        for request in failed:
+            request.finish(error)
+        self.slots = [None] * self.max_batch
+        self.admitting = None
+
+    def _loop(self):
+        while True:
+            try:
+                self._admit()
+                self._step()
+            except Exception as e:
+                traceback.print_exc()
+                self._fail(e)
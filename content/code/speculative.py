@@ -0,0 +1,104 @@
+# speculative sampling: a small draft GPT proposes k tokens one by one (cheap), the big
+# target GPT checks all k in a single forward pass. each proposal is accepted with
+# probability min(1, p/q) and on the first rejection we resample from max(0, p - q), which
+# makes the output distributed exactly like sampling the target on its own (here: the
+# top-k=50 sampler of the training loop). with a decent draft most proposals get accepted,
+# so we get several tokens per target forward instead of one
+# python speculative.py --draft gpt2 --target gpt2-xl --prompt "Hello, I'm a language model,"
+import argparse
+import time
+import torch
+from torch.nn import functional as F
+
+from gpt import GPT, KVCache
+from sampling import num_tokens
+
+def top_k_probs(logits, top_k):
+    # the distribution sampling.sample draws from at temperature 1, as a dense (..., num_tokens)
+    # tensor: the padded vocab slots past the tokenizer's 50257 are cut off, same as there
+    probs = F.softmax(logits[..., :num_tokens].float(), dim=-1)
+    topk_probs, topk_indices = torch.topk(probs, top_k, dim=-1)
+    probs = torch.zeros_like(probs).scatter_(-1, topk_indices, topk_probs)
+    return probs / probs.sum(dim=-1, keepdim=True)
+
+@torch.no_grad()
+def speculative_generate(target, draft, tokens, max_length, k=4, top_k=50, generator=None):
+    # returns (prompt + completion tokens, number of target forwards)
+    device = next(target.parameters()).device
+    device_type = 'cuda' if device.type == 'cuda' else 'cpu'
+    V = min(target.config.vocab_size, num_tokens) # tokens we can ever sample
+    assert draft.config.vocab_size <= V, "draft vocab has to fit in the target vocab"
+    max_length = min(max_length, target.config.block_size, draft.config.block_size)
+    tokens = list(tokens)
+    target_cache = KVCache(target.config, 1, max_len=max_length)
+    draft_cache = KVCache(draft.config, 1, max_len=max_length)
+
+    def forward(model, idx, kv_cache):
+        x = torch.tensor([idx], dtype=torch.long, device=device)
+        with torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=device_type == 'cuda'):
+            logits, _ = model(x, kv_cache=kv_cache)
+        return logits[0] # (T, vocab_size)
+
+    def sample(probs):
+        return torch.multinomial(probs, 1, generator=generator).item()
+
+    # invariant: the target cache holds every token but the last one,
+    # the draft cache holds tokens[:draft_cache.pos] (it can lag behind by one)
+    if len(tokens) > 1:
+        forward(target, tokens[:-1], target_cache)
+    target_forwards = 0
+    while len(tokens) < max_length:
+        n_draft = min(k, max_length - len(tokens) - 1)
+        # 1) draft k tokens autoregressively, remembering the distribution each came from
+        proposals, draft_probs = [], []
+        for _ in range(n_draft):
+            logits = forward(draft, (tokens + proposals)[draft_cache.pos:], draft_cache)
+            q = top_k_probs(logits[-1], top_k)
+            q = F.pad(q, (0, V - q.size(-1))) # the draft may not have the padded vocab slots
+            proposals.append(sample(q))
+            draft_probs.append(q)
+        # 2) score the last token and all proposals with one target forward
+        p = top_k_probs(forward(target, tokens[-1:] + proposals, target_cache), top_k) # (n_draft + 1, V)
+        target_forwards += 1
+        # 3) accept / reject left to right
+        n_accepted = 0
+        next_token = None
+        for i, d in enumerate(proposals):
+            u = torch.rand((), generator=generator, device=device).item()
+            if u < min(1.0, (p[i, d] / draft_probs[i][d]).item()):
+                n_accepted += 1
+                continue
+            residual = torch.clamp(p[i] - draft_probs[i], min=0.0)
+            next_token = sample(residual / residual.sum())
+            break
+        if next_token is None:
+            next_token = sample(p[n_accepted]) # everything accepted: a free token from the target
+        tokens += proposals[:n_accepted] + [next_token]
+        # 4) roll both caches back to what is actually in the sequence now
+        target_cache.pos = len(tokens) - 1
+        draft_cache.pos = min(draft_cache.pos, len(tokens) - 1)
+    return tokens, target_forwards
+
+if __name__ == "__main__":
+    import tiktoken
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--draft", type=str, default="gpt2")
+    parser.add_argument("--target", type=str, default="gpt2-xl")
+    parser.add_argument("--prompt", type=str, default="Hello, I'm a language model,")
+    parser.add_argument("--max_length", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    enc = tiktoken.get_encoding("gpt2")
+    target = GPT.from_pretrained(args.target).to(device).eval()
+    draft = GPT.from_pretrained(args.draft).to(device).eval()
+    prompt = enc.encode(args.prompt)
+    generator = torch.Generator(device=device)
+    generator.manual_seed(42)
+    t0 = time.time()
+    tokens, target_forwards = speculative_generate(target, draft, prompt, args.max_length, k=args.k, generator=generator)
+    dt = time.time() - t0
+    n_new = len(tokens) - len(prompt)
+    print(enc.decode(tokens))
+    print(f"{n_new} tokens in {dt:.2f}s ({n_new / dt:.2f} tok/sec), {n_new / target_forwards:.2f} tokens per target forward")
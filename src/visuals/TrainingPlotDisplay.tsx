@@ -1,18 +1,122 @@
+'use client'
+
+import React, { useEffect, useState } from 'react'
 import Image from 'next/image'
+import { LineChart, Line, XAxis, YAxis, Tooltip, Legend, ResponsiveContainer } from 'recharts'
+
+// series as exported by content/code/metrics.py: { name: { step: [...], value: [...] } },
+// already downsampled (LTTB), so the whole 19k step run is a few thousand points at most
+type Series = { step: number[]; value: number[] }
+type Metrics = Record<string, Series>
+
+interface TrainingPlotDisplayProps {
+  src?: string
+}
+
+const colors: Record<string, string> = {
+  train: 'rgba(100, 255, 218, 0.6)',
+  val: '#ff6b6b',
+  hella: '#ffc864',
+}
+
+const axisStyle = { fill: 'rgba(224, 230, 237, 0.7)', fontSize: 10, fontFamily: 'monospace' }
+
+const tooltipStyle = {
+  background: 'rgba(10, 15, 30, 0.95)',
+  border: '1px solid rgba(100, 255, 218, 0.3)',
+  borderRadius: '6px',
+  fontFamily: 'monospace',
+  fontSize: '11px',
+}
+
+function toPoints(series: Series) {
+  return series.step.map((step, i) => ({ step, value: series.value[i] }))
+}
+
+export default function TrainingPlotDisplay({ src = '/data/training_metrics.json' }: TrainingPlotDisplayProps) {
+  const [metrics, setMetrics] = useState<Metrics | null>(null)
+  const [failed, setFailed] = useState(false)
+
+  useEffect(() => {
+    fetch(src)
+      .then((res) => (res.ok ? res.json() : Promise.reject(res.status)))
+      .then(setMetrics)
+      .catch(() => setFailed(true))
+  }, [src])
+
+  if (failed) {
+    // no exported metrics: the static plot
+    return (
+      <div className="flex items-center justify-center h-full p-4">
+        <div className="max-w-full max-h-full">
+          <Image
+            src="/images/training_eval_plot.png"
+            alt="Training and evaluation loss plots showing model performance"
+            width={800}
+            height={400}
+            className="rounded-lg shadow-lg"
+            style={{ objectFit: 'contain' }}
+          />
+        </div>
+      </div>
+    )
+  }
+
+  if (!metrics) {
+    return (
+      <div
+        className="animate-pulse w-full h-32 rounded"
+        style={{ background: 'rgba(10, 15, 30, 0.9)', border: '1px solid rgba(100, 255, 218, 0.2)' }}
+      />
+    )
+  }
+
+  const losses = ['train', 'val'].filter((name) => metrics[name])
+  const hella = metrics['hella']
 
-export default function TrainingPlotDisplay() {
   return (
-    <div className="flex items-center justify-center h-full p-4">
-      <div className="max-w-full max-h-full">
-        <Image
-          src="/images/training_eval_plot.png"
-          alt="Training and evaluation loss plots showing model performance"
-          width={800}
-          height={400}
-          className="rounded-lg shadow-lg"
-          style={{ objectFit: 'contain' }}
-        />
+    <div
+      className="flex flex-col h-full p-4 gap-4"
+      style={{ background: 'linear-gradient(135deg, #0a0e27 0%, #151932 100%)', fontFamily: 'monospace' }}
+    >
+      <div style={{ color: '#e0e6ed', fontSize: '14px' }}>loss</div>
+      <div className="flex-1 min-h-0">
+        <ResponsiveContainer width="100%" height="100%">
+          <LineChart margin={{ top: 8, right: 16, bottom: 8, left: 0 }}>
+            <XAxis dataKey="step" type="number" domain={['dataMin', 'dataMax']} tick={axisStyle} />
+            <YAxis type="number" domain={['auto', 'auto']} tick={axisStyle} />
+            <Tooltip contentStyle={tooltipStyle} labelFormatter={(step) => `step ${step}`} />
+            <Legend wrapperStyle={{ fontSize: '11px' }} />
+            {losses.map((name) => (
+              <Line
+                key={name}
+                name={name}
+                data={toPoints(metrics[name])}
+                dataKey="value"
+                stroke={colors[name]}
+                dot={false}
+                strokeWidth={name === 'val' ? 2 : 1}
+                isAnimationActive={false}
+              />
+            ))}
+          </LineChart>
+        </ResponsiveContainer>
       </div>
+      {hella && (
+        <>
+          <div style={{ color: '#e0e6ed', fontSize: '14px' }}>hellaswag accuracy</div>
+          <div style={{ height: '30%' }}>
+            <ResponsiveContainer width="100%" height="100%">
+              <LineChart data={toPoints(hella)} margin={{ top: 8, right: 16, bottom: 8, left: 0 }}>
+                <XAxis dataKey="step" type="number" domain={['dataMin', 'dataMax']} tick={axisStyle} />
+                <YAxis type="number" domain={['auto', 'auto']} tick={axisStyle} />
+                <Tooltip contentStyle={tooltipStyle} labelFormatter={(step) => `step ${step}`} />
+                <Line dataKey="value" name="hella" stroke={colors.hella} dot={false} isAnimationActive={false} />
+              </LineChart>
+            </ResponsiveContainer>
+          </div>
+        </>
+      )}
     </div>
   )
-}
\ No newline at end of file
+}